@@ -1,7 +1,11 @@
 import boto3
-import datetime
+import base64
+import json
+import struct
+from datetime import datetime, timezone
 from decimal import Decimal
 import logging
+from rollups import update_rollups
 
 # Configure the logging module
 logger = logging.getLogger()
@@ -10,25 +14,142 @@ logger.setLevel(logging.INFO)
 dynamodb = boto3.resource('dynamodb')
 table_name = 'DHT11'
 table = dynamodb.Table(table_name)
+# Per-station minute/hour aggregates, see rollups.py
+rollup_table = dynamodb.Table(table_name + '_rollups')
 
-def lambda_handler(event, context):
-    # Log information using the logging module
-    logger.info("EVENT")
-    topic = event['topic']
-    time_stamp = event['time_stamp']
-    temperature = Decimal(event['temperature'])
-    humidity = Decimal(event['humidity'])
-    
-    logger.info(time_stamp)
-    
-    # Write to DynamoDB
-    table.put_item(
-        Item={
-            'time_stamp': time_stamp,
+# Key attributes of the table, from its key schema (read once per container):
+# a batch keeps only the last reading per key, since BatchWriteItem rejects
+# two writes to the same item
+def primary_keys():
+    return [key['AttributeName'] for key in table.key_schema]
+
+def to_item(reading):
+    # Convert a DHT11 reading into a DynamoDB item
+    item = {
+        'time_stamp': reading['time_stamp'],
+        'temperature': Decimal(str(reading['temperature'])),
+        'humidity': Decimal(str(reading['humidity'])),
+        'topic': reading['topic']
+    }
+    # Epoch milliseconds from the device's NTP-synced clock, a numeric
+    # alternative to time_stamp for sort keys and range conditions
+    if 'timestamp_ms' in reading:
+        item['timestamp_ms'] = int(reading['timestamp_ms'])
+    return item
+
+# Compact payload of the Pico W (PAYLOAD_FORMAT = "binary" in
+# PicoW_dht11_Mqtt.py): a version byte, then per reading the epoch seconds,
+# milliseconds, temperature and humidity. The device publishes it on
+# '<topic>/bin', and the IoT rule for that topic passes it base64 encoded:
+# SELECT encode(*, 'base64') AS data, topic() AS topic FROM 'DHT11/bin'
+BINARY_VERSION = 1
+BINARY_RECORD = struct.Struct('<IHbB')
+BINARY_TOPIC_SUFFIX = '/bin'
+
+def decode_binary(payload, topic='DHT11'):
+    if payload[:1] != bytes([BINARY_VERSION]) or (len(payload) - 1) % BINARY_RECORD.size:
+        raise ValueError('Not a version %d binary payload' % BINARY_VERSION)
+    readings = []
+    for seconds, milliseconds, temperature, humidity in BINARY_RECORD.iter_unpack(payload[1:]):
+        time_stamp = datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        readings.append({
+            'time_stamp': '%s.%09d' % (time_stamp, milliseconds * 1000000),
+            'timestamp_ms': seconds * 1000 + milliseconds,
             'temperature': temperature,
             'humidity': humidity,
             'topic': topic
-        }
-    )
-    
-    logger.info('Done Inputting')
\ No newline at end of file
+        })
+    return readings
+
+def decode_payload(payload):
+    # A reading, an array of readings, a binary payload or the base64
+    # envelope of one built by the IoT rule, as a list of readings
+    if isinstance(payload, (bytes, bytearray)) and payload[:1] == bytes([BINARY_VERSION]):
+        return decode_binary(payload)
+    if isinstance(payload, (bytes, bytearray, str)):
+        payload = json.loads(payload)
+    if isinstance(payload, dict) and 'data' in payload:
+        topic = payload.get('topic', 'DHT11')
+        if topic.endswith(BINARY_TOPIC_SUFFIX):
+            topic = topic[:-len(BINARY_TOPIC_SUFFIX)]
+        return decode_binary(base64.b64decode(payload['data']), topic)
+    return payload if isinstance(payload, list) else [payload]
+
+def extract_readings(event):
+    # Returns (record id, reading) pairs and the ids of records that could not
+    # be parsed. Accepts a single reading (IoT rule), a JSON array of readings,
+    # a binary payload envelope, or SQS/Kinesis records whose bodies hold any
+    # of those.
+    if isinstance(event, list):
+        return [(str(i), reading) for i, reading in enumerate(event)], set()
+    if 'Records' not in event:
+        try:
+            return [(None, reading) for reading in decode_payload(event)], set()
+        except (ValueError, TypeError, struct.error):
+            return [], {None}
+
+    readings = []
+    failures = set()
+    for record in event['Records']:
+        try:
+            if 'kinesis' in record:
+                record_id = record['kinesis']['sequenceNumber']
+                body = base64.b64decode(record['kinesis']['data'])
+            else:
+                record_id = record['messageId']
+                body = record['body']
+            payload = decode_payload(body)
+        except (KeyError, ValueError, TypeError, struct.error):
+            failures.add(record.get('messageId') or record.get('kinesis', {}).get('sequenceNumber'))
+            continue
+        for reading in payload:
+            readings.append((record_id, reading))
+    return readings, failures
+
+def lambda_handler(event, context):
+    # An event straight from the IoT rule has no records to report as failed,
+    # so it fails as a whole instead and the rule's error action gets it
+    direct = isinstance(event, list) or 'Records' not in event
+    readings, failures = extract_readings(event)
+
+    items = []
+    for record_id, reading in readings:
+        try:
+            items.append((record_id, to_item(reading)))
+        except (KeyError, TypeError, ValueError, ArithmeticError):
+            failures.add(record_id)
+    if direct and failures:
+        raise ValueError('Invalid readings in the event: %s' % json.dumps(event, default=str))
+
+    # Keep the last reading per key, as the batch writer would, so the
+    # rollups count a reading delivered twice in this event only once
+    keys = primary_keys()
+    items = list({tuple(item.get(key) for key in keys): (record_id, item)
+                  for record_id, item in items}.values())
+
+    # Write to DynamoDB, 25 items per BatchWriteItem request
+    if items:
+        try:
+            with table.batch_writer(overwrite_by_pkeys=keys) as batch:
+                for record_id, item in items:
+                    batch.put_item(Item=item)
+        except Exception:
+            logger.exception('Batch write failed')
+            if direct:
+                raise
+            failures.update(record_id for record_id, item in items)
+        else:
+            # Only once the readings are stored, so retried records are not
+            # counted twice; a failure here leaves the raw data intact
+            try:
+                update_rollups(rollup_table, [item for record_id, item in items],
+                               metrics=['temperature', 'humidity'])
+            except Exception:
+                logger.exception('Rollup update failed')
+
+    logger.info('Stored %d readings, %d records failed', len(items), len(failures))
+
+    # Partial batch response: SQS/Kinesis retry only the failed records
+    return {
+        'batchItemFailures': [{'itemIdentifier': record_id} for record_id in failures if record_id is not None]
+    }
@@ -0,0 +1,117 @@
+# Per-station minute/hour rollups maintained at ingest time.
+#
+# A copy of this module lives in both LambdaFunction/ and transparent_bridge/,
+# since each folder is deployed on its own;
+# transparent_bridge/test_shared_modules.py fails when they differ.
+#
+# Rollup items are keyed by the station (partition key 'ID') and
+# '<resolution>#<bucket start>' (sort key 'bucket'), for example
+# 'minute#2024-05-01 10:42' or 'hour#2024-05-01 10'. For every metric they
+# hold <metric>_min, _max, _sum, _mean and _last, plus 'count' and the
+# 'last_timestamp' seen, so readers fetch one item per bucket instead of
+# every raw reading.
+
+from decimal import Decimal, InvalidOperation
+
+from boto3.dynamodb.conditions import Attr
+
+# resolution -> length of the 'YYYY-MM-DD HH:MM:SS' prefix naming its bucket
+RESOLUTIONS = {'minute': 16, 'hour': 13}
+
+STATION_KEYS = ('ID', 'topic')
+TIME_KEYS = ('timestamp', 'time_stamp')
+
+
+def _first(item, keys):
+    for key in keys:
+        if key in item:
+            return item[key]
+    return None
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, Decimal):
+        return value
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return None
+
+
+def combine(rollup, other):
+    """Merge two rollups of the same bucket; either may be a single reading."""
+    if rollup is None:
+        return dict(other)
+    merged = dict(rollup)
+    merged['count'] = rollup['count'] + other['count']
+    newer = other['last_timestamp'] >= rollup['last_timestamp']
+    if newer:
+        merged['last_timestamp'] = other['last_timestamp']
+    for attribute, value in other.items():
+        if attribute.endswith('_min'):
+            merged[attribute] = min(value, rollup.get(attribute, value))
+        elif attribute.endswith('_max'):
+            merged[attribute] = max(value, rollup.get(attribute, value))
+        elif attribute.endswith('_sum'):
+            merged[attribute] = value + rollup.get(attribute, 0)
+            merged[attribute[:-4] + '_mean'] = merged[attribute] / merged['count']
+        elif attribute.endswith('_last') and (newer or attribute not in rollup):
+            merged[attribute] = value
+    return merged
+
+
+def aggregate(items, metrics=None):
+    """Fold raw readings into one rollup per (station, bucket). Metrics
+    default to every numeric attribute of a reading."""
+    rollups = {}
+    for item in items:
+        station = _first(item, STATION_KEYS)
+        timestamp = _first(item, TIME_KEYS)
+        if station is None or timestamp is None:
+            continue
+        reading = {'count': 1, 'last_timestamp': timestamp}
+        for name in metrics or item:
+            if name in STATION_KEYS or name in TIME_KEYS:
+                continue
+            value = _number(item.get(name))
+            if value is not None:
+                for suffix in ('_min', '_max', '_sum', '_mean', '_last'):
+                    reading[name + suffix] = value
+        for resolution, length in RESOLUTIONS.items():
+            key = (station, f"{resolution}#{timestamp[:length]}")
+            rollups[key] = combine(rollups.get(key), reading)
+    return rollups
+
+
+def update_rollups(table, items, metrics=None, retries=5):
+    """Merge a batch of stored readings into the rollup table.
+
+    Each bucket the batch touches costs one read and one write, guarded by a
+    version number so concurrent writers re-read and retry instead of
+    overwriting each other's counts. Call this only once the raw items are
+    stored, so a batch whose write failed and is retried is not counted
+    twice. Merging does not remember which readings it has seen: a reading
+    delivered again later (a QoS 1 redelivery landing in another batch, an
+    SQS message received twice) is counted again, so counts and means may
+    run slightly high; the raw table, keyed by reading, stays exact."""
+    for (station, bucket), rollup in aggregate(items, metrics).items():
+        key = {'ID': station, 'bucket': bucket}
+        for _ in range(retries):
+            current = table.get_item(Key=key, ConsistentRead=True).get('Item')
+            if current is None:
+                merged = dict(rollup, version=1)
+                condition = Attr('ID').not_exists()
+            else:
+                merged = combine(current, rollup)
+                merged['version'] = current['version'] + 1
+                condition = Attr('version').eq(current['version'])
+            merged.update(key)
+            try:
+                table.put_item(Item=merged, ConditionExpression=condition)
+                break
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                continue
+        else:
+            print(f"Giving up on rollup {station} {bucket} after {retries} conflicting writes")
@@ -0,0 +1,167 @@
+import base64
+import json
+import os
+import unittest
+from decimal import Decimal
+from unittest import mock
+
+# boto3 needs a region to build the module level resources; the tests swap
+# the tables for FakeTable before anything is sent
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambdaFunction
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class FakeTable:
+    """In-memory stand-in for a boto3 DynamoDB Table, keyed like the real
+    ones: 'time_stamp' for readings, ('ID', 'bucket') for rollups."""
+
+    def __init__(self, keys=('time_stamp',), fail=False):
+        self.keys = keys
+        self.fail = fail
+        self.items = {}
+        self.key_schema = [{'AttributeName': key, 'KeyType': 'HASH' if i == 0 else 'RANGE'}
+                           for i, key in enumerate(keys)]
+        self.meta = mock.Mock()
+        self.meta.client.exceptions.ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def key(self, item):
+        return tuple(item[key] for key in self.keys)
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(self.key(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, Item, ConditionExpression=None):
+        if self.fail:
+            raise RuntimeError('write failed')
+        self.items[self.key(Item)] = dict(Item)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        self.overwrite_by_pkeys = overwrite_by_pkeys
+        return FakeBatchWriter(self)
+
+
+class FakeBatchWriter:
+
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+
+def reading(second, temperature=21, humidity=40):
+    return {
+        'time_stamp': '2024-05-01 10:42:%02d.000000000' % second,
+        'temperature': temperature,
+        'humidity': humidity,
+        'topic': 'DHT11',
+    }
+
+
+class LambdaHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = FakeTable()
+        self.rollup_table = FakeTable(keys=('ID', 'bucket'))
+        for name, table in (('table', self.table), ('rollup_table', self.rollup_table)):
+            patcher = mock.patch.object(lambdaFunction, name, table)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def handle(self, event):
+        result = lambdaFunction.lambda_handler(event, None)
+        return sorted(failure['itemIdentifier'] for failure in result['batchItemFailures'])
+
+    def test_single_event(self):
+        self.assertEqual(self.handle(reading(1, temperature=21.5)), [])
+        item = self.table.items[('2024-05-01 10:42:01.000000000',)]
+        self.assertEqual(item['temperature'], Decimal('21.5'))
+        self.assertEqual(item['topic'], 'DHT11')
+        rollup = self.rollup_table.items[('DHT11', 'minute#2024-05-01 10:42')]
+        self.assertEqual(rollup['count'], 1)
+        self.assertEqual(rollup['temperature_max'], Decimal('21.5'))
+
+    def test_array(self):
+        self.assertEqual(self.handle([reading(1), reading(2), reading(3)]), [])
+        self.assertEqual(len(self.table.items), 3)
+        rollup = self.rollup_table.items[('DHT11', 'minute#2024-05-01 10:42')]
+        self.assertEqual(rollup['count'], 3)
+
+    def test_duplicates_counted_once(self):
+        event = {'Records': [
+            {'messageId': 'sqs-1', 'body': json.dumps([reading(1), reading(2)])},
+            {'messageId': 'sqs-2', 'body': json.dumps(reading(2, temperature=23))},
+        ]}
+        self.assertEqual(self.handle(event), [])
+        self.assertEqual(len(self.table.items), 2)
+        rollup = self.rollup_table.items[('DHT11', 'minute#2024-05-01 10:42')]
+        self.assertEqual(rollup['count'], 2)
+        self.assertEqual(rollup['temperature_last'], 23)
+
+    def test_array_with_a_bad_reading(self):
+        # a direct event fails as a whole, for the IoT rule's error action
+        bad = reading(2)
+        del bad['humidity']
+        with self.assertRaises(ValueError):
+            self.handle([reading(1), bad, reading(3)])
+        self.assertEqual(self.table.items, {})
+
+    def test_sqs_array_with_a_bad_reading(self):
+        bad = reading(2)
+        del bad['humidity']
+        event = {'Records': [
+            {'messageId': 'sqs-1', 'body': json.dumps([reading(1), bad])},
+            {'messageId': 'sqs-2', 'body': json.dumps(reading(3))},
+        ]}
+        self.assertEqual(self.handle(event), ['sqs-1'])
+        self.assertEqual(len(self.table.items), 2)
+
+    def test_mixed_records(self):
+        event = {'Records': [
+            {'messageId': 'sqs-1', 'body': json.dumps(reading(1))},
+            {'kinesis': {'sequenceNumber': 'kinesis-1',
+                         'data': base64.b64encode(json.dumps([reading(2), reading(3)]).encode()).decode()}},
+            {'messageId': 'sqs-bad', 'body': 'not json'},
+            {'kinesis': {'sequenceNumber': 'kinesis-bad', 'data': base64.b64encode(b'{').decode()}},
+        ]}
+        self.assertEqual(self.handle(event), ['kinesis-bad', 'sqs-bad'])
+        self.assertEqual(len(self.table.items), 3)
+
+    def test_write_failure(self):
+        self.table.fail = True
+        event = {'Records': [
+            {'messageId': 'sqs-1', 'body': json.dumps(reading(1))},
+            {'messageId': 'sqs-2', 'body': json.dumps([reading(2), reading(3)])},
+        ]}
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.handle(event), ['sqs-1', 'sqs-2'])
+        # nothing stored, so nothing counted
+        self.assertEqual(self.rollup_table.items, {})
+
+    def test_direct_write_failure(self):
+        self.table.fail = True
+        with self.assertLogs(level='ERROR'), self.assertRaises(RuntimeError):
+            self.handle(reading(1))
+        self.assertEqual(self.rollup_table.items, {})
+
+    def test_keys_from_the_table(self):
+        self.table.key_schema = [{'AttributeName': 'topic', 'KeyType': 'HASH'},
+                                 {'AttributeName': 'time_stamp', 'KeyType': 'RANGE'}]
+        self.assertEqual(self.handle([reading(1), reading(2)]), [])
+        self.assertEqual(self.table.overwrite_by_pkeys, ['topic', 'time_stamp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,11 +2,14 @@ import machine
 import network
 import ssl
 import ubinascii
-from simple import MQTTClient
+from spool import Spool, MQTTClient
 from machine import Pin
 import dht
 import time
+import ntptime
 import json
+import struct
+from array import array
 
 
 
@@ -18,21 +21,169 @@ MQTT_CLIENT_CERT = ""
 MQTT_BROKER = ""
 MQTT_BROKER_CA = "AmazonRootCA1.pem"
 
+# "json" publishes a JSON object on MQTT_TOPIC; "binary" publishes the packed
+# format below on MQTT_TOPIC + BINARY_TOPIC_SUFFIX, about 5x smaller
+PAYLOAD_FORMAT = "json"
+MQTT_TOPIC = "DHT11"
+BINARY_TOPIC_SUFFIX = "/bin"
+
+# Binary payload: a version byte, then one 8 byte record per reading, all
+# little endian: epoch seconds (uint32), milliseconds (uint16), temperature
+# in °C (int8) and humidity in % (uint8). Decoded by the Lambda and the bridge
+BINARY_VERSION = 1
+BINARY_RECORD = "<IHbB"
+
+# time.time() counts from 2000 on some MicroPython ports
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+# The clock is set from NTP whenever Wi-Fi comes up and CLOCK_SYNC_INTERVAL
+# seconds have passed since the last sync. Readings are stamped in epoch
+# milliseconds counted from the last sync with time.ticks_ms(), and every
+# stamp is later than the one before, even when a sync sets the clock back
+CLOCK_SYNC_INTERVAL = 6 * 3600  # s
+
+# The DHT11 only updates about once per second, so readings are sampled every
+# SAMPLE_INTERVAL seconds into a ring buffer and published together every
+# PUBLISH_INTERVAL seconds: as a JSON array, or as one binary payload holding
+# every record. A reading within the deadband of the last one kept is dropped,
+# unless none was kept for HEARTBEAT_INTERVAL seconds. When the buffer is full
+# the oldest readings are overwritten
+SAMPLE_INTERVAL = 1         # s
+PUBLISH_INTERVAL = 10       # s
+BUFFER_SIZE = 64            # readings
+DEADBAND_TEMPERATURE = 0    # °C
+DEADBAND_HUMIDITY = 0       # %
+HEARTBEAT_INTERVAL = 60     # s
+
+# Readings that cannot be published while Wi-Fi or the broker is down are
+# appended to segment files on flash (the oldest segment is deleted when
+# they hold more than SPOOL_CAPACITY) and sent once reconnected, DRAIN_BATCH per message and one message every
+# DRAIN_INTERVAL seconds. QoS 1 makes sure a batch reached the broker before
+# it leaves the spool; up to MAX_INFLIGHT publishes may await their PUBACK
+# at once, so each one does not cost a round trip
+SPOOL_FILE = "spool.bin"
+SPOOL_CAPACITY = 4096       # readings, 8 bytes each on flash
+SPOOL_SEGMENT = 256         # readings per segment file
+DRAIN_BATCH = 32            # readings
+DRAIN_INTERVAL = 1          # s
+RECONNECT_MIN = 1           # s before the first reconnect attempt, doubled after each failure
+RECONNECT_MAX = 120         # s
+MQTT_QOS = 1
+MAX_INFLIGHT = 4
+
+# "awake" keeps Wi-Fi and the broker connection up between samples. "low"
+# uploads every UPLOAD_INTERVAL seconds (or once the buffer is full),
+# powering Wi-Fi down in between, and lightsleeps between samples. In both,
+# sampling slows down while readings stay within the deadband, doubling the
+# interval up to SAMPLE_INTERVAL_MAX seconds, and goes back to
+# SAMPLE_INTERVAL on a change. A reading outside the alarm limits is sent at
+# once, so an alarm is reported within SAMPLE_INTERVAL_MAX seconds plus the
+# time to connect
+POWER_MODE = "awake"
+UPLOAD_INTERVAL = 300       # s
+SAMPLE_INTERVAL_MAX = 30    # s
+ALARM_TEMPERATURE = (0, 40) # °C, lowest and highest normal value
+ALARM_HUMIDITY = (20, 80)   # %
+
 dht_pin = machine.Pin(2)
 dht_sesnor = dht.DHT11(dht_pin)
 
-def get_timestamp():
-    # Get the current time in seconds since epoch
-    t = time.localtime()  # Get local time tuple
-    # Get microseconds since an arbitrary point
-    microseconds = time.ticks_us() % 1000000  
-    nanoseconds = microseconds * 1000  # Approximate nanoseconds
-    
+class ReadingBuffer:
+    # Fixed size ring of readings, one preallocated array per field, so
+    # sampling allocates nothing
+    def __init__(self, size):
+        self.size = size
+        self.seconds = array("I", [0] * size)
+        self.milliseconds = array("H", [0] * size)
+        self.temperature = array("b", [0] * size)
+        self.humidity = array("B", [0] * size)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, seconds, milliseconds, temperature, humidity):
+        index = (self.start + self.count) % self.size
+        if self.count == self.size:
+            self.start = (self.start + 1) % self.size
+        else:
+            self.count += 1
+        self.seconds[index] = seconds
+        self.milliseconds[index] = milliseconds
+        self.temperature[index] = temperature
+        self.humidity[index] = humidity
+
+    def readings(self):
+        # oldest first, as (epoch seconds, milliseconds, temperature, humidity)
+        for i in range(self.count):
+            index = (self.start + i) % self.size
+            yield (self.seconds[index], self.milliseconds[index],
+                   self.temperature[index], self.humidity[index])
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+buffer = ReadingBuffer(BUFFER_SIZE)
+clock_ms = (time.time() + EPOCH_OFFSET) * 1000   # epoch milliseconds at clock_ticks
+clock_ticks = time.ticks_ms()
+last_stamp = 0
+last_sync = None
+last_kept = None   # the last reading added to the buffer
+
+def sync_clock():
+    global clock_ms, clock_ticks, last_sync
+    if last_sync is not None and time.ticks_diff(time.ticks_ms(), last_sync) < CLOCK_SYNC_INTERVAL * 1000:
+        return
+    try:
+        ntptime.settime()
+    except Exception as e:
+        print("Error setting the clock from NTP", str(e))
+        return
+    clock_ms = (time.time() + EPOCH_OFFSET) * 1000
+    clock_ticks = last_sync = time.ticks_ms()
+    print("Clock set from NTP")
+
+def epoch_ms():
+    global clock_ms, clock_ticks, last_stamp
+    # moving clock_ticks along keeps the difference well within the
+    # wrap-around of ticks_ms
+    now = time.ticks_ms()
+    clock_ms += time.ticks_diff(now, clock_ticks)
+    clock_ticks = now
+    last_stamp = max(clock_ms, last_stamp + 1)
+    return last_stamp
+
+def format_timestamp(seconds, milliseconds):
     # Format the timestamp: YYYY-MM-DD HH:MM:SS.NNNNNNNNN
-    timestamp = "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}.{:09d}".format(
-        t[0], t[1], t[2], t[3], t[4], t[5], nanoseconds
+    t = time.localtime(seconds - EPOCH_OFFSET)
+    return "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}.{:09d}".format(
+        t[0], t[1], t[2], t[3], t[4], t[5], milliseconds * 1000000
     )
-    return timestamp
+
+def encode_readings(readings):
+    # readings: (epoch seconds, milliseconds, temperature, humidity) tuples
+    payload = bytearray(1 + struct.calcsize(BINARY_RECORD) * len(readings))
+    payload[0] = BINARY_VERSION
+    offset = 1
+    for reading in readings:
+        struct.pack_into(BINARY_RECORD, payload, offset, *reading)
+        offset += struct.calcsize(BINARY_RECORD)
+    return payload
+
+def encode_batch(readings):
+    # topic and payload of a batch of (epoch seconds, milliseconds, temperature, humidity)
+    if PAYLOAD_FORMAT == "binary":
+        return MQTT_TOPIC + BINARY_TOPIC_SUFFIX, encode_readings(readings)
+    payload = [{
+    "time_stamp": format_timestamp(seconds, milliseconds),
+    "timestamp_ms": seconds * 1000 + milliseconds,
+    "temperature": temperature,
+    "humidity": humidity,
+    "topic": MQTT_TOPIC
+    } for seconds, milliseconds, temperature, humidity in readings]
+    return MQTT_TOPIC, json.dumps(payload)
 
 def read_pem(file):
     with open(file, "r") as input:
@@ -41,67 +192,155 @@ def read_pem(file):
         base64_text = "".join(split_text[1:-1])
         return ubinascii.a2b_base64(base64_text)
 
+def load_der(file):
+    # DER contents of a PEM file, decoded on first boot and cached next to it
+    try:
+        with open(file + ".der", "rb") as input:
+            return input.read()
+    except OSError:
+        der = read_pem(file)
+        with open(file + ".der", "wb") as output:
+            output.write(der)
+        return der
+
 def connect_internet():
     try:
         sta_if = network.WLAN(network.STA_IF)
+        if sta_if.isconnected():
+            sync_clock()
+            return True
         sta_if.active(True)
         sta_if.connect(SSID, WIFI_PASSWORD)
 
         for i in range(0, 10):
             if not sta_if.isconnected():
                 time.sleep(1)
-        print("Connected to Wi-Fi")
+        if sta_if.isconnected():
+            print("Connected to Wi-Fi")
+            sync_clock()
+        return sta_if.isconnected()
     except Exception as e:
         print('There was an issue connecting to WIFI')
         print(e)
+        return False
 
+def sample_dht11_values():
+    global last_kept
 
-def publish_dht11_values():  
-    
     try:
         dht_sesnor.measure()
-        time_stamp = get_timestamp()
-        payload = {
-        "time_stamp": time_stamp,
-        "temperature": dht_sesnor.temperature(),
-        "humidity": dht_sesnor.humidity(),
-        "topic": "DHT11"
-        }
-        
-        mqtt_client.publish('DHT11', json.dumps(payload))
-        print("PUBLISHED: ", str(payload))
-          
+        stamp = epoch_ms()
+        reading = (stamp // 1000, stamp % 1000,
+                   dht_sesnor.temperature(), dht_sesnor.humidity())
     except Exception as e:
         print("Error reading DHT11", str(e))
+        return False
+
+    # True if the reading left the deadband of the last one kept
+    changed = (last_kept is None
+               or abs(reading[2] - last_kept[2]) > DEADBAND_TEMPERATURE
+               or abs(reading[3] - last_kept[3]) > DEADBAND_HUMIDITY)
+    if changed or reading[0] - last_kept[0] >= HEARTBEAT_INTERVAL:
+        buffer.append(*reading)
+        last_kept = reading
+    return changed
+
+def alarming(reading):
+    return reading is not None and not (
+        ALARM_TEMPERATURE[0] <= reading[2] <= ALARM_TEMPERATURE[1]
+        and ALARM_HUMIDITY[0] <= reading[3] <= ALARM_HUMIDITY[1])
+
+
+def publish_dht11_values():  
+    
+    if not len(buffer):
+        return
+    readings = list(buffer.readings())
+    buffer.clear()
+    if mqtt_client.send(readings, MQTT_QOS):
+        print("PUBLISHED: ", len(readings), "readings")
+    else:
+        print("SPOOLED: ", len(readings), "readings,", len(spool), "waiting")
+
+def disconnect_internet():
+    sta_if = network.WLAN(network.STA_IF)
+    sta_if.disconnect()
+    sta_if.active(False)
+
+def upload_dht11_values():
+    # Wi-Fi and the broker up, every waiting reading sent, both down again
+    mqtt_client.reconnect()
+    publish_dht11_values()
+    mqtt_client.flush(MQTT_QOS)
+    try:
+        if mqtt_client.connected:
+            mqtt_client.disconnect()
+    except OSError as e:
+        print("Error disconnecting from the MQTT broker", str(e))
+    disconnect_internet()
            
 
-connect_internet()
+# The context keeps the parsed certificates and key for every reconnect
+context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+context.verify_mode = ssl.CERT_REQUIRED
+context.load_cert_chain(load_der(MQTT_CLIENT_CERT), load_der(MQTT_CLIENT_KEY))
+context.load_verify_locations(cadata=load_der(MQTT_BROKER_CA))
 
-key = read_pem(MQTT_CLIENT_KEY)
-cert = read_pem(MQTT_CLIENT_CERT)
-ca = read_pem(MQTT_BROKER_CA)
+spool = Spool(SPOOL_FILE, BINARY_RECORD, SPOOL_CAPACITY, SPOOL_SEGMENT)
 
 mqtt_client = MQTTClient(
     MQTT_CLIENT_ID,
     MQTT_BROKER,
+    spool,
+    encode_batch,
+    batch=DRAIN_BATCH,
+    drain_interval=DRAIN_INTERVAL * 1000,
+    max_inflight=MAX_INFLIGHT,
+    network=connect_internet,
+    backoff_min=RECONNECT_MIN * 1000,
+    backoff_max=RECONNECT_MAX * 1000,
     keepalive=60,
-    ssl=True,
-    ssl_params={
-        "key": key,
-        "cert": cert,
-        "server_hostname": MQTT_BROKER,
-        "cert_reqs": ssl.CERT_REQUIRED,
-        "cadata": ca,
-    },
+    ssl=context,
 )
 
+# Set the clock before the first reading
+if POWER_MODE == "awake":
+    print(f"Connecting to MQTT broker")
+    mqtt_client.reconnect()
+elif connect_internet():
+    disconnect_internet()
 
-print(f"Connecting to MQTT broker")
-mqtt_client.connect()
-print("Done Connecting, sending Values")
-
+interval = SAMPLE_INTERVAL
+next_sample = time.ticks_ms()
+last_publish = time.ticks_ms()
 while True:
-    publish_dht11_values()
-    time.sleep(0.1)
+    urgent = False
+    if time.ticks_diff(time.ticks_ms(), next_sample) >= 0:
+        changed = sample_dht11_values()
+        alarm = alarming(last_kept)
+        urgent = changed and alarm
+        interval = SAMPLE_INTERVAL if changed or alarm else min(interval * 2, SAMPLE_INTERVAL_MAX)
+        next_sample = time.ticks_add(time.ticks_ms(), interval * 1000)
+
+    if POWER_MODE == "awake":
+        mqtt_client.maintain(MQTT_QOS)
+        if mqtt_client.connected:
+            sync_clock()
+        if urgent or time.ticks_diff(time.ticks_ms(), last_publish) >= PUBLISH_INTERVAL * 1000:
+            publish_dht11_values()
+            last_publish = time.ticks_ms()
+    elif (urgent or len(buffer) == BUFFER_SIZE
+            or time.ticks_diff(time.ticks_ms(), last_publish) >= UPLOAD_INTERVAL * 1000):
+        upload_dht11_values()
+        last_publish = time.ticks_ms()
+
+    wait = time.ticks_diff(next_sample, time.ticks_ms())
+    if POWER_MODE == "awake":
+        if mqtt_client.connected and len(spool):
+            # keep forwarding the spool at its own pace
+            wait = min(wait, DRAIN_INTERVAL * 1000)
+        time.sleep_ms(max(wait, 0))
+    elif wait > 0:
+        machine.lightsleep(wait)
 
 
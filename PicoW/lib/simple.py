@@ -8,7 +8,7 @@ class MQTTException(Exception):
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, max_inflight=1):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
@@ -26,11 +26,22 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Outgoing PUBLISH packets are built whole in buf, which only grows,
+        # and written with a single call
+        self.buf = bytearray(128)
+        # Packet ids of QoS 1 publishes awaiting their PUBACK, 0 for a free
+        # slot. With one slot publish() waits for the PUBACK; with more it
+        # returns once the packet is sent and only waits while all are taken
+        self.inflight = [0] * max_inflight
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
+    def _new_pid(self):
+        self.pid = self.pid % 65535 + 1
+        return self.pid
+
     def _recv_len(self):
         n = 0
         sh = 0
@@ -52,13 +63,20 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
-    def connect(self, clean_session=True):
+    def connect(self, clean_session=True, timeout=None):
+        for i in range(len(self.inflight)):
+            self.inflight[i] = 0
         self.sock = socket.socket()
+        self.sock.settimeout(timeout)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
-        if self.ssl:
+        if self.ssl is True:
             import ssl
             self.sock = ssl.wrap_socket(self.sock, **self.ssl_params)
+        elif self.ssl:
+            # an SSLContext, which keeps its certificates and key parsed
+            # across connections
+            self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
 
@@ -107,45 +125,64 @@ class MQTTClient:
         self.sock.write(b"\xc0\0")
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        assert qos in (0, 1), "QoS 2 is not supported"
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
+        n = sz + (2 if sz < 0x80 else 3 if sz < 0x4000 else 4)
+        if len(self.buf) < n:
+            self.buf = bytearray(n)
+        pkt = self.buf
+        pkt[0] = 0x30 | qos << 1 | retain
         i = 1
         while sz > 0x7f:
             pkt[i] = (sz & 0x7f) | 0x80
             sz >>= 7
             i += 1
         pkt[i] = sz
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        struct.pack_into("!H", pkt, i + 1, len(topic))
+        i += 3
+        pkt[i:i + len(topic)] = topic
+        i += len(topic)
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            pid = self._new_pid()
+            struct.pack_into("!H", pkt, i, pid)
+            i += 2
+        pkt[i:n] = msg
+        #print(hex(n), hexlify(pkt[:n], ":"))
+        if qos == 0:
+            self.sock.write(pkt, n)
+            return
+        while 0 not in self.inflight:
+            self.wait_msg()
+        self.inflight[self.inflight.index(0)] = pid
+        self.sock.write(pkt, n)
+        if len(self.inflight) == 1:
+            self.wait_puback(pid)
+        return pid
+
+    # Number of QoS 1 publishes not yet acknowledged
+    def pending(self):
+        return len(self.inflight) - self.inflight.count(0)
+
+    def wait_puback(self, pid=None):
+        # for the given publish, or for all of them
+        while (pid in self.inflight) if pid else self.pending():
+            self.wait_msg()
+
+    # Called with the packet id of every acknowledged QoS 1 publish
+    def puback(self, pid):
+        pass
 
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
         pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self._new_pid())
         #print(hex(len(pkt)), hexlify(pkt, ":"))
         self.sock.write(pkt)
         self._send_str(topic)
@@ -164,9 +201,12 @@ class MQTTClient:
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
-    def wait_msg(self):
+    def wait_msg(self, nonblocking=False):
         res = self.sock.read(1)
-        self.sock.setblocking(True)
+        # back to blocking after check_msg; this drops the connect timeout,
+        # so it is only done then
+        if nonblocking:
+            self.sock.setblocking(True)
         if res is None:
             return None
         if res == b"":
@@ -176,6 +216,15 @@ class MQTTClient:
             assert sz == 0
             return None
         op = res[0]
+        if op == 0x40:  # PUBACK
+            sz = self.sock.read(1)
+            assert sz == b"\x02"
+            rcv_pid = self.sock.read(2)
+            rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+            if rcv_pid in self.inflight:
+                self.inflight[self.inflight.index(rcv_pid)] = 0
+                self.puback(rcv_pid)
+            return op
         if op & 0xf0 != 0x30:
             return op
         sz = self._recv_len()
@@ -201,5 +250,5 @@ class MQTTClient:
     # the same processing as wait_msg.
     def check_msg(self):
         self.sock.setblocking(False)
-        return self.wait_msg()
+        return self.wait_msg(True)
 
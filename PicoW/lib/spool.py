@@ -0,0 +1,309 @@
+import os
+import random
+import select
+import time
+import ustruct as struct
+import simple
+
+# Store-and-forward for readings that could not be published.
+#
+# Spool keeps fixed size records (packed with a "<..." struct format) in
+# append-only segment files on flash, "<path>.<n>" holding up to `segment`
+# records numbered from n. Records are only ever appended, a whole batch
+# with one write, and a segment is deleted once every record in it is sent,
+# so flash is never rewritten in place. The number of the oldest unsent
+# record is saved in a small side file once per drained batch, not per
+# record. Nothing is written to flash while the broker is reachable. When
+# the spool holds more than `capacity` records its oldest segment is
+# deleted.
+
+def split(path):
+    i = path.rfind("/")
+    if i < 0:
+        return "", path
+    return path[:i] or "/", path[i + 1:]
+
+class Spool:
+
+    def __init__(self, path, fmt, capacity, segment=256):
+        self.path = path
+        self.fmt = fmt
+        self.size = struct.calcsize(fmt)
+        self.capacity = capacity
+        self.segment = min(segment, capacity)
+        self.files = []      # [first record number, records] per segment, oldest first
+        directory, name = split(path)
+        prefix = name + "."
+        for entry in os.listdir(directory) if directory else os.listdir():
+            if entry.startswith(prefix) and entry[len(prefix):].isdigit():
+                first = int(entry[len(prefix):])
+                self.files.append([first, os.stat(self.name(first))[6] // self.size])
+        self.files.sort()
+        # a write cut short by a reset may have left part of a record at the
+        # end of the last segment, so never append to it again
+        self.appendable = False
+        self.head = self.files[-1][0] + self.files[-1][1] if self.files else 0
+        try:
+            with open(path + ".tail", "rb") as f:
+                self.tail = struct.unpack("<I", f.read(4))[0]
+        except (OSError, ValueError):
+            self.tail = 0
+        self.tail = min(max(self.tail, self.files[0][0] if self.files else 0), self.head)
+        self.trim()
+
+    def name(self, first):
+        return self.path + "." + str(first)
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def extend(self, records):
+        data = b"".join(struct.pack(self.fmt, *record) for record in records)
+        done = 0
+        while done < len(records):
+            if not self.appendable or self.files[-1][1] >= self.segment:
+                self.files.append([self.head, 0])
+                self.appendable = True
+            n = min(len(records) - done, self.segment - self.files[-1][1])
+            with open(self.name(self.files[-1][0]), "ab") as f:
+                f.write(data[done * self.size:(done + n) * self.size])
+            self.files[-1][1] += n
+            self.head += n
+            done += n
+        self.trim()
+
+    def peek(self, n, skip=0):
+        # the n oldest records after the first `skip`, oldest first
+        start = self.tail + skip
+        end = min(start + n, self.head)
+        records = []
+        for first, count in self.files:
+            low, high = max(start, first), min(end, first + count)
+            if low < high:
+                with open(self.name(first), "rb") as f:
+                    f.seek((low - first) * self.size)
+                    data = f.read((high - low) * self.size)
+                for i in range(0, len(data), self.size):
+                    records.append(struct.unpack_from(self.fmt, data, i))
+        return records
+
+    def drop(self, n):
+        self.tail = min(self.tail + n, self.head)
+        self.trim()
+        with open(self.path + ".tail", "wb") as f:
+            f.write(struct.pack("<I", self.tail))
+
+    def trim(self):
+        # delete the segments that are sent, or too old to keep
+        while self.files and (self.files[0][0] + self.files[0][1] <= self.tail
+                              or (len(self.files) > 1 and self.head - self.files[0][0] > self.capacity)):
+            first, count = self.files.pop(0)
+            os.remove(self.name(first))
+            self.tail = max(self.tail, first + count)
+        if not self.files:
+            self.appendable = False
+
+
+# An MQTTClient that spools the readings it cannot publish and forwards them
+# once connected again, oldest first, `batch` records per message and at most
+# one message every `drain_interval` ms, so a long outage is not replayed to
+# the broker all at once. encode(records) returns the (topic, payload) of a
+# batch of records.
+#
+# With QoS 1 and more than one in-flight slot (max_inflight), publishes do
+# not wait for their PUBACK: a spooled batch stays in the spool until it is
+# acknowledged, and the records of an unacknowledged direct publish are
+# spooled if the connection is lost. The broker acknowledges QoS 1 publishes
+# in the order it received them.
+#
+# maintain() keeps the connection up: it reconnects after a random delay
+# that doubles with every failed attempt, from backoff_min up to backoff_max
+# ms, first bringing the network up with network() if given, and it sends a
+# PINGREQ when nothing was sent for half the keepalive or nothing received
+# for half of it, giving the connection up when nothing was received for 1.5
+# times the keepalive.
+
+class MQTTClient(simple.MQTTClient):
+
+    def __init__(self, client_id, server, spool, encode, batch=32, drain_interval=1000,
+                 timeout=10, network=None, backoff_min=1000, backoff_max=60000, **kwargs):
+        super().__init__(client_id, server, **kwargs)
+        self.spool = spool
+        self.encode = encode
+        self.batch = batch
+        self.drain_interval = drain_interval
+        self.timeout = timeout
+        self.connected = False
+        self.last_drain = time.ticks_ms()
+        self.sent = []       # (pid, records, or the number of spooled records) awaiting PUBACK
+        self.sending = 0     # spooled records published but not yet acknowledged
+        self.poller = select.poll()
+        self.network = network
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.backoff = backoff_min
+        self.next_attempt = time.ticks_ms()
+        self.last_sent = self.last_received = self.last_ping = time.ticks_ms()
+
+    def connect(self, clean_session=True):
+        # with a socket timeout a dead connection fails a publish instead
+        # of blocking it
+        self.connected = False
+        try:
+            present = super().connect(clean_session, self.timeout)
+        except Exception:
+            if self.sock:
+                self.sock.close()
+            raise
+        self.sent = []
+        self.sending = 0
+        self.poller = select.poll()
+        self.poller.register(self.sock, select.POLLIN)
+        self.last_sent = self.last_received = self.last_ping = time.ticks_ms()
+        self.connected = True
+        return present
+
+    def disconnect(self):
+        self.connected = False
+        super().disconnect()
+
+    def lost(self, e):
+        print("MQTT connection lost", str(e))
+        self.connected = False
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        unsent = []
+        for pid, item in self.sent:
+            if not isinstance(item, int):
+                unsent.extend(item)
+        if unsent:
+            self.spool.extend(unsent)
+        self.sent = []
+        self.sending = 0
+        # don't have every device hit the broker again at the same moment
+        self.next_attempt = time.ticks_add(time.ticks_ms(), random.randint(0, self.backoff))
+
+    def reconnect(self):
+        if self.connected:
+            return True
+        if time.ticks_diff(time.ticks_ms(), self.next_attempt) < 0:
+            return False
+        try:
+            if self.network and not self.network():
+                raise OSError("network down")
+            self.connect()
+            self.backoff = self.backoff_min
+            print("Connected to the MQTT broker")
+            return True
+        except Exception as e:
+            delay = random.randint(self.backoff // 2, self.backoff)
+            print("Could not connect to the MQTT broker, retrying in", delay, "ms", str(e))
+            self.next_attempt = time.ticks_add(time.ticks_ms(), delay)
+            self.backoff = min(self.backoff * 2, self.backoff_max)
+            return False
+
+    def keep_alive(self):
+        if not self.connected or not self.keepalive:
+            return
+        now = time.ticks_ms()
+        half = self.keepalive * 500
+        if time.ticks_diff(now, self.last_received) > self.keepalive * 1500:
+            self.lost(OSError("no answer within the keepalive"))
+        elif (time.ticks_diff(now, self.last_sent) >= half
+                or (time.ticks_diff(now, self.last_received) >= half
+                    and time.ticks_diff(now, self.last_ping) >= half)):
+            try:
+                self.ping()
+            except OSError as e:
+                self.lost(e)
+
+    def maintain(self, qos=0):
+        # call often: reconnects, pings and forwards spooled records as due
+        self.reconnect()
+        self.receive()
+        self.keep_alive()
+        self.drain(qos)
+
+    def ping(self):
+        super().ping()
+        self.last_sent = self.last_ping = time.ticks_ms()
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        pid = super().publish(topic, msg, retain, qos)
+        self.last_sent = time.ticks_ms()
+        return pid
+
+    def wait_msg(self, nonblocking=False):
+        op = super().wait_msg(nonblocking)
+        self.last_received = time.ticks_ms()
+        return op
+
+    def receive(self):
+        # handle whatever the broker sent (PUBACKs) without blocking
+        try:
+            while self.connected and self.poller.poll(0):
+                self.wait_msg()
+        except OSError as e:
+            self.lost(e)
+
+    def puback(self, pid):
+        for i in range(len(self.sent)):
+            if self.sent[i][0] == pid:
+                item = self.sent.pop(i)[1]
+                if isinstance(item, int):
+                    self.sending -= item
+                    self.spool.drop(item)
+                return
+
+    def forward(self, records, spooled, qos):
+        topic, payload = self.encode(records)
+        pid = self.publish(topic, payload, qos=qos)
+        if pid in self.inflight:
+            self.sent.append((pid, len(records) if spooled else records))
+            if spooled:
+                self.sending += len(records)
+        elif spooled:
+            self.spool.drop(len(records))
+
+    def send(self, records, qos=0):
+        # Publish the records, or spool them behind the ones still waiting;
+        # True if they were published right away
+        self.receive()
+        if self.connected and not len(self.spool):
+            try:
+                self.forward(records, False, qos)
+                return True
+            except OSError as e:
+                self.lost(e)
+        self.spool.extend(records)
+        self.drain(qos)
+        return False
+
+    def flush(self, qos=0):
+        # Forward everything spooled, drain_interval apart, and wait for the
+        # PUBACKs; before closing the connection
+        while self.connected and len(self.spool) > self.sending:
+            self.drain(qos)
+            if self.connected and len(self.spool) > self.sending:
+                time.sleep_ms(self.drain_interval)
+        try:
+            if self.connected:
+                self.wait_puback()
+        except OSError as e:
+            self.lost(e)
+
+    def drain(self, qos=0):
+        # Forward the next batch of spooled records, if it is time to
+        self.receive()
+        if not self.connected or len(self.spool) <= self.sending:
+            return
+        if time.ticks_diff(time.ticks_ms(), self.last_drain) < self.drain_interval:
+            return
+        self.last_drain = time.ticks_ms()
+        records = self.spool.peek(self.batch, self.sending)
+        try:
+            self.forward(records, True, qos)
+        except OSError as e:
+            self.lost(e)
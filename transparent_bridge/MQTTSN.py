@@ -18,11 +18,9 @@
 
 # Low-level protocol interface for MQTTs
 
-try:
-  False = not True
-except NameError:
-  True = (1 == 1)
-  False = not True
+from __future__ import print_function
+
+import struct
 
 # Message types
 ADVERTISE, SEARCHGW, GWINFO, reserved, \
@@ -46,35 +44,97 @@ packetNames = [ "ADVERTISE", "SEARCHGW", "GWINFO", "reserved", \
 TopicIdType_Names = ["NORMAL", "PREDEFINED", "SHORT_NAME"]
 TOPIC_NORMAL, TOPIC_PREDEFINED, TOPIC_SHORTNAME = range(3)
 
+# Header layouts: <Length:1><MsgType:1>, or <0x01><Length:2><MsgType:1> when
+# the packet is 256 bytes or longer
+SHORT_HEADER = struct.Struct("!BB")
+LONG_HEADER = struct.Struct("!BHB")
+INT16 = struct.Struct("!H")
+
 def writeInt16(length):
-  return chr(length / 256)+ chr(length % 256)
+  return INT16.pack(length)
 
 def readInt16(buf):
-  return ord(buf[0])*256 + ord(buf[1])
+  return INT16.unpack_from(buf)[0]
+
+def toBytes(data):
+  "wire representation of a text or binary field"
+  if isinstance(data, type(u"")):
+    return data.encode("utf-8")
+  return data
+
+def toText(view):
+  "native string from a text field on the wire"
+  if str is bytes:
+    return view.tobytes()
+  return view.tobytes().decode("utf-8")
 
 def getPacket(aSocket):
   "receive the next packet"
-  buf, address = aSocket.recvfrom(65535) # get the first byte fixed header
-  if buf == "":
+  buf, address = aSocket.recvfrom(65535)
+  if not buf:
     return None
-  
-  length = ord(buf[0])
-  if length == 1:
-    if buf == "":
-      return None
-    length = readInt16(buf[1:])
-    
   return buf, address
 
+def decodeHeader(view):
+  "return (Length, MsgType, offset of the first field) of a packet"
+  length, msgtype = SHORT_HEADER.unpack_from(view)
+  if length == 1:
+    length, msgtype = LONG_HEADER.unpack_from(view)[1:]
+    return length, msgtype, LONG_HEADER.size
+  return length, msgtype, SHORT_HEADER.size
+
 def MessageType(buf):
-  if ord(buf[0]) == 1:
-    msgtype = ord(buf[3])
-  else:
-    msgtype = ord(buf[1])
-  return msgtype
+  return decodeHeader(buf)[1]
+
+
+class Layouts:
+  "precompiled wire layout of the fixed fields following the header"
+
+  def __init__(self, format):
+    self.body = struct.Struct("!" + format)
+    self.size = self.body.size
+    self.short = struct.Struct("!BB" + format)
+    self.long = struct.Struct("!BHB" + format)
+
+# Fixed fields of each message type, indexed by MsgType.  Variable length
+# data (topic names, client ids, publish data) follows the fixed fields up
+# to the end of the packet.
+layouts = [Layouts("BH"), Layouts("H"), Layouts("B"), None,
+           Layouts("BBH"), Layouts("B"),
+           Layouts(""), Layouts("B"), Layouts(""), Layouts(""),
+           Layouts("HH"), Layouts("HHB"),
+           Layouts("BHH"), Layouts("HHB"), Layouts("H"), Layouts("H"), Layouts("H"), None,
+           Layouts("BH"), Layouts("BHHB"), Layouts("BH"), Layouts("H"),
+           Layouts(""), Layouts(""), Layouts(""), None,
+           Layouts("B"), Layouts("H"), Layouts(""), Layouts("H")]
+
+def decode(buffer):
+  """decode a packet without copying it: returns (Length, MsgType, fields,
+  data) where fields is the tuple of the fixed fields of the message type
+  and data is a memoryview onto the variable length part of the packet.
+  Raises ValueError for a reserved or unknown message type"""
+  view = memoryview(buffer)
+  length, msgtype, pos = decodeHeader(view)
+  if msgtype >= len(layouts) or layouts[msgtype] == None:
+    raise ValueError("reserved message type %d" % msgtype)
+  layout = layouts[msgtype]
+  fields = layout.body.unpack_from(view, pos)
+  return length, msgtype, fields, view[pos + layout.size:length]
+
+def encode(msgtype, fields=(), data=b""):
+  "encode a packet into a new string buffer"
+  layout = layouts[msgtype]
+  data = toBytes(data)
+  length = 2 + layout.size + len(data)
+  if length < 256:
+    return layout.short.pack(length, msgtype, *fields) + data
+  length += 2
+  assert length <= 65535
+  return layout.long.pack(1, length, msgtype, *fields) + data
+
 
 class Flags:
-  
+
   def __init__(self):
     self.DUP = False          # 1 bit
     self.QoS = 0              # 2 bits
@@ -82,7 +142,7 @@ class Flags:
     self.Will = False         # 1 bit
     self.CleanSession = True  # 1 bit
     self.TopicIdType = 0      # 2 bits
-    
+
   def __eq__(self, flags):
     return self.DUP == flags.DUP and \
          self.QoS == flags.QoS and \
@@ -90,34 +150,38 @@ class Flags:
          self.Will == flags.Will and \
          self.CleanSession == flags.CleanSession and \
          self.TopicIdType == flags.TopicIdType
-  
+
   def __ne__(self, flags):
     return not self.__eq__(flags)
-  
+
   def __str__(self):
     "return printable representation of our data"
     return '{DUP '+str(self.DUP)+ \
            ", QoS "+str(self.QoS)+", Retain "+str(self.Retain) + \
            ", Will "+str(self.Will)+", CleanSession "+str(self.CleanSession) + \
            ", TopicIdType "+str(self.TopicIdType)+"}"
-    
-  def pack(self):
-    "pack data into string buffer ready for transmission down socket"
-    buffer = chr( (self.DUP << 7) | (self.QoS << 5) | (self.Retain << 4) | \
-         (self.Will << 3) | (self.CleanSession << 2) | self.TopicIdType )
-    #print "Flags - pack", str(bin(ord(buffer))), len(buffer)
-    return buffer
-  
-  def unpack(self, buffer):
-    "unpack data from string buffer into separate fields"
-    b0 = ord(buffer[0])
-    #print "Flags - unpack", str(bin(b0)), len(buffer), buffer
+
+  def encode(self):
+    "return the flags as a single byte value"
+    return (self.DUP << 7) | (self.QoS << 5) | (self.Retain << 4) | \
+         (self.Will << 3) | (self.CleanSession << 2) | self.TopicIdType
+
+  def decode(self, b0):
+    "set the flags from a single byte value"
     self.DUP = ((b0 >> 7) & 0x01) == 1
     self.QoS = (b0 >> 5) & 0x03
     self.Retain = ((b0 >> 4) & 0x01) == 1
     self.Will = ((b0 >> 3) & 0x01) == 1
     self.CleanSession = ((b0 >> 2) & 0x01) == 1
     self.TopicIdType = (b0 & 0x03)
+
+  def pack(self):
+    "pack data into string buffer ready for transmission down socket"
+    return struct.pack("!B", self.encode())
+
+  def unpack(self, buffer):
+    "unpack data from string buffer into separate fields"
+    self.decode(struct.unpack_from("!B", buffer)[0])
     return 1
 
 class MessageHeaders:
@@ -136,36 +200,20 @@ class MessageHeaders:
   def pack(self, length):
     "pack data into string buffer ready for transmission down socket"
     # length does not yet include the length or msgtype bytes we are going to add
-    buffer = self.encode(length) + chr(self.MsgType)
-    return buffer
-
-  def encode(self, length):
     self.Length = length + 2
     assert 2 <= self.Length <= 65535
     if self.Length < 256:
-      buffer = chr(self.Length)
-      print "length", self.Length
-    else:
-      self.Length += 2
-      buffer = chr(1) + writeInt16(self.Length)
-    return buffer
+      return SHORT_HEADER.pack(self.Length, self.MsgType)
+    self.Length += 2
+    return LONG_HEADER.pack(1, self.Length, self.MsgType)
 
   def unpack(self, buffer):
     "unpack data from string buffer into separate fields"
-    (self.Length, bytes) = self.decode(buffer)
-    self.MsgType = ord(buffer[bytes])
-    return bytes + 1
-
-  def decode(self, buffer):
-    value = ord(buffer[0])
-    if value > 1:
-      bytes = 1
-    else:
-      value = readInt16(buffer[1:])
-      bytes = 3
-    return (value, bytes)
+    (self.Length, self.MsgType, pos) = decodeHeader(buffer)
+    return pos
 
 def writeUTF(aString):
+  aString = toBytes(aString)
   return writeInt16(len(aString)) + aString
 
 def readUTF(buffer):
@@ -174,16 +222,36 @@ def readUTF(buffer):
 
 
 class Packets:
+  """Packet classes are a compatibility facade over the codec above: pack
+  encodes the attributes with encode(), and unpack hands the fields decoded
+  from the message type's layout to unpackFields"""
 
   def pack(self):
-    return self.mh.pack(0)
+    return self.encode()
+
+  def encode(self, fields=(), data=b""):
+    data = encode(self.mh.MsgType, fields, data)
+    self.mh.Length = len(data)
+    return data
+
+  def unpack(self, buffer):
+    view = memoryview(buffer)
+    msgtype = self.mh.MsgType
+    pos = self.mh.unpack(view)
+    assert self.mh.MsgType == msgtype
+    layout = layouts[msgtype]
+    self.unpackFields(layout.body.unpack_from(view, pos),
+                      view[pos + layout.size:self.mh.Length])
+
+  def unpackFields(self, fields, data):
+    pass
 
   def __str__(self):
     return str(self.mh)
 
   def __eq__(self, packet):
-    return False if packet == None else self.mh == packet.mh
-  
+    return False if packet is None else self.mh == packet.mh
+
   def __ne__(self, packet):
     return not self.__eq__(packet)
 
@@ -195,27 +263,22 @@ class Advertises(Packets):
     self.Duration = 0 # 2 bytes
     if buffer:
       self.unpack(buffer)
-      
+
   def pack(self):
-    buffer = chr(self.GwId) + writeInt16(self.Duration)
-    return self.mh.pack(len(buffer)) + buffer
-  
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == ADVERTISE
-    self.GwId = ord(buffer[pos])
-    pos += 1
-    self.Duration = readInt16(buffer[pos:])
-    
+    return self.encode((self.GwId, self.Duration))
+
+  def unpackFields(self, fields, data):
+    self.GwId, self.Duration = fields
+
   def __str__(self):
     return str(self.mh) + " GwId "+str(self.GwId)+" Duration "+str(self.Duration)
-    
+
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and \
            self.GwId == packet.GwId and \
            self.Duration == packet.Duration
-  
-  
+
+
 class SearchGWs(Packets):
 
   def __init__(self, buffer=None):
@@ -223,20 +286,16 @@ class SearchGWs(Packets):
     self.Radius = 0
     if buffer:
       self.unpack(buffer)
-      
+
   def pack(self):
-    buffer = writeInt16(self.Radius)
-    buffer = self.mh.pack(len(buffer)) + buffer
-    return buffer
-  
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == SEARCHGW
-    self.Radius = readInt16(buffer[pos:])
-    
+    return self.encode((self.Radius,))
+
+  def unpackFields(self, fields, data):
+    self.Radius, = fields
+
   def __str__(self):
     return str(self.mh) + " Radius "+str(self.Radius)
-    
+
 class GWInfos(Packets):
 
   def __init__(self, buffer=None):
@@ -245,28 +304,18 @@ class GWInfos(Packets):
     self.GwAdd = None # optional
     if buffer:
       self.unpack(buffer)
-      
+
   def pack(self):
-    buffer = chr(self.GwId)
-    if self.GwAdd:
-      buffer += self.GwAdd
-    buffer = self.mh.pack(len(buffer)) + buffer
-    return buffer
-  
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == GWINFO
-    self.GwId = buffer[pos]
-    pos += 1
-    if pos >= self.mh.Length:
-      self.GwAdd = None
-    else:
-      self.GwAdd = buffer[pos:]
-          
+    return self.encode((self.GwId,), self.GwAdd or b"")
+
+  def unpackFields(self, fields, data):
+    self.GwId, = fields
+    self.GwAdd = data.tobytes() if len(data) else None
+
   def __str__(self):
     buf = str(self.mh) + " Radius "+str(self.GwId)
     if self.GwAdd:
-      buf += " GwAdd "+self.GwAdd
+      buf += " GwAdd "+str(self.GwAdd)
     return buf
 
 class Connects(Packets):
@@ -281,18 +330,12 @@ class Connects(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = self.Flags.pack() + chr(self.ProtocolId) + writeInt16(self.Duration) + self.ClientId
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.Flags.encode(), self.ProtocolId, self.Duration), self.ClientId)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == CONNECT
-    pos += self.Flags.unpack(buffer[pos])
-    self.ProtocolId = ord(buffer[pos])
-    pos += 1
-    self.Duration = readInt16(buffer[pos:])
-    pos += 2
-    self.ClientId = buffer[pos:]
+  def unpackFields(self, fields, data):
+    flags, self.ProtocolId, self.Duration = fields
+    self.Flags.decode(flags)
+    self.ClientId = toText(data)
 
   def __str__(self):
     buf = str(self.mh) + ", " + str(self.Flags) + \
@@ -319,13 +362,10 @@ class Connacks(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = chr(self.ReturnCode)
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.ReturnCode,))
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == CONNACK
-    self.ReturnCode = ord(buffer[pos])
+  def unpackFields(self, fields, data):
+    self.ReturnCode, = fields
 
   def __str__(self):
     return str(self.mh)+", ReturnCode "+str(self.ReturnCode)
@@ -342,11 +382,7 @@ class WillTopicReqs(Packets):
     if buffer != None:
       self.unpack(buffer)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLTOPICREQ
-    
-    
+
 class WillTopics(Packets):
 
   def __init__(self, buffer = None):
@@ -357,14 +393,11 @@ class WillTopics(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = self.flags.pack() + self.WillTopic
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.flags.encode(),), self.WillTopic)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLTOPIC
-    pos += self.flags.unpack(buffer[pos:])
-    self.WillTopic = buffer[pos:self.mh.Length]
+  def unpackFields(self, fields, data):
+    self.flags.decode(fields[0])
+    self.WillTopic = toText(data)
 
   def __str__(self):
     return str(self.mh)+", Flags "+str(self.flags)+", WillTopic "+self.WillTopic
@@ -373,7 +406,7 @@ class WillTopics(Packets):
     return Packets.__eq__(self, packet) and \
            self.flags == packet.flags and \
            self.WillTopic == packet.WillTopic
-          
+
 class WillMsgReqs(Packets):
 
   def __init__(self, buffer = None):
@@ -381,11 +414,7 @@ class WillMsgReqs(Packets):
     if buffer != None:
       self.unpack(buffer)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLMSGREQ
-    
-    
+
 class WillMsgs(Packets):
 
   def __init__(self, buffer = None):
@@ -395,12 +424,10 @@ class WillMsgs(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    return self.mh.pack(len(self.WillMsg)) + self.WillMsg
+    return self.encode((), self.WillMsg)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLMSG
-    self.WillMsg = buffer[pos:self.mh.Length]
+  def unpackFields(self, fields, data):
+    self.WillMsg = toText(data)
 
   def __str__(self):
     return str(self.mh)+", WillMsg "+self.WillMsg
@@ -408,7 +435,7 @@ class WillMsgs(Packets):
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and \
            self.WillMsg == packet.WillMsg
-          
+
 class Registers(Packets):
 
   def __init__(self, buffer = None):
@@ -420,17 +447,11 @@ class Registers(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.TopicId) + writeInt16(self.MsgId) + self.TopicName
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.TopicId, self.MsgId), self.TopicName)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == REGISTER
-    self.TopicId = readInt16(buffer[pos:])
-    pos += 2
-    self.MsgId = readInt16(buffer[pos:])
-    pos += 2
-    self.TopicName = buffer[pos:self.mh.Length]
+  def unpackFields(self, fields, data):
+    self.TopicId, self.MsgId = fields
+    self.TopicName = toText(data)
 
   def __str__(self):
     return str(self.mh)+", TopicId "+str(self.TopicId)+", MsgId "+str(self.MsgId)+", TopicName "+self.TopicName
@@ -453,17 +474,10 @@ class Regacks(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.TopicId) + writeInt16(self.MsgId) + chr(self.ReturnCode)
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.TopicId, self.MsgId, self.ReturnCode))
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == REGACK
-    self.TopicId = readInt16(buffer[pos:])
-    pos += 2
-    self.MsgId = readInt16(buffer[pos:])
-    pos += 2
-    self.ReturnCode = ord(buffer[pos])
+  def unpackFields(self, fields, data):
+    self.TopicId, self.MsgId, self.ReturnCode = fields
 
   def __str__(self):
     return str(self.mh)+", TopicId "+str(self.TopicId)+", MsgId "+str(self.MsgId)+", ReturnCode "+str(self.ReturnCode)
@@ -475,6 +489,13 @@ class Regacks(Packets):
            self.ReturnCode == packet.ReturnCode
 
 
+def shortNameToId(name):
+  "the two characters of a short topic name as a 2 byte topic id"
+  return readInt16((toBytes(name) + b"  ")[0:2])
+
+def idToShortName(topicId):
+  return toText(memoryview(writeInt16(topicId)))
+
 class Publishes(Packets):
 
   def __init__(self, buffer = None):
@@ -483,38 +504,30 @@ class Publishes(Packets):
     self.TopicId = 0 # 2 bytes
     self.TopicName = ""
     self.MsgId = 0 # 2 bytes
-    self.Data = ""
+    self.Data = b""
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    buffer = self.Flags.pack()
-    if self.Flags.TopicIdType in [TOPIC_NORMAL, TOPIC_PREDEFINED, 3]:
-      print "topic id is", self.TopicId
-      buffer += writeInt16(self.TopicId)
-    elif self.Flags.TopicIdType == TOPIC_SHORTNAME:
-      buffer += (self.TopicName + "  ")[0:2]
-    buffer += writeInt16(self.MsgId) + self.Data
-    return self.mh.pack(len(buffer)) + buffer
+    if self.Flags.TopicIdType == TOPIC_SHORTNAME:
+      topicId = shortNameToId(self.TopicName)
+    else:
+      topicId = self.TopicId
+    return self.encode((self.Flags.encode(), topicId, self.MsgId), self.Data)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == PUBLISH
-    pos += self.Flags.unpack(buffer[pos:])
-    
+  def unpackFields(self, fields, data):
+    flags, topicId, self.MsgId = fields
+    self.Flags.decode(flags)
     self.TopicId = 0
     self.TopicName = ""
     if self.Flags.TopicIdType in [TOPIC_NORMAL, TOPIC_PREDEFINED]:
-      self.TopicId = readInt16(buffer[pos:])
+      self.TopicId = topicId
     elif self.Flags.TopicIdType == TOPIC_SHORTNAME:
-      self.TopicName = buffer[pos:pos+2]
-    pos += 2
-    self.MsgId = readInt16(buffer[pos:])
-    pos += 2
-    self.Data = buffer[pos:self.mh.Length]
+      self.TopicName = idToShortName(topicId)
+    self.Data = data.tobytes()
 
   def __str__(self):
-    return str(self.mh)+", Flags "+str(self.Flags)+", TopicId "+str(self.TopicId)+", MsgId "+str(self.MsgId)+", Data "+self.Data
+    return str(self.mh)+", Flags "+str(self.Flags)+", TopicId "+str(self.TopicId)+", MsgId "+str(self.MsgId)+", Data "+str(self.Data)
 
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and \
@@ -535,17 +548,10 @@ class Pubacks(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.TopicId) + writeInt16(self.MsgId) + chr(self.ReturnCode)
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.TopicId, self.MsgId, self.ReturnCode))
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == PUBACK
-    self.TopicId = readInt16(buffer[pos:])
-    pos += 2
-    self.MsgId = readInt16(buffer[pos:])
-    pos += 2
-    self.ReturnCode = ord(buffer[pos])
+  def unpackFields(self, fields, data):
+    self.TopicId, self.MsgId, self.ReturnCode = fields
 
   def __str__(self):
     return str(self.mh)+", TopicId "+str(self.TopicId)+" , MsgId "+str(self.MsgId)+", ReturnCode "+str(self.ReturnCode)
@@ -555,45 +561,22 @@ class Pubacks(Packets):
            self.TopicId == packet.TopicId and \
            self.MsgId == packet.MsgId and \
            self.ReturnCode == packet.ReturnCode
-          
-          
-class Pubrecs(Packets):
 
-  def __init__(self, buffer = None):
-    self.mh = MessageHeaders(PUBREC)
-    self.MsgId = 0
-    if buffer != None:
-      self.unpack(buffer)
-
-  def pack(self):
-    return self.mh.pack(2) + writeInt16(self.MsgId)
-
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == PUBREC
-    self.MsgId = readInt16(buffer[pos:])
 
-  def __str__(self):
-    return str(self.mh)+" , MsgId "+str(self.MsgId)
-
-  def __eq__(self, packet):
-    return Packets.__eq__(self, packet) and self.MsgId == packet.MsgId
-    
-class Pubrels(Packets):
+class MsgIdPackets(Packets):
+  "packets whose only field is the message id"
 
   def __init__(self, buffer = None):
-    self.mh = MessageHeaders(PUBREL)
+    self.mh = MessageHeaders(self.msgType)
     self.MsgId = 0
     if buffer != None:
       self.unpack(buffer)
 
   def pack(self):
-    return self.mh.pack(2) + writeInt16(self.MsgId)
+    return self.encode((self.MsgId,))
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == PUBREL
-    self.MsgId = readInt16(buffer[pos:])
+  def unpackFields(self, fields, data):
+    self.MsgId, = fields
 
   def __str__(self):
     return str(self.mh)+" , MsgId "+str(self.MsgId)
@@ -601,30 +584,16 @@ class Pubrels(Packets):
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and self.MsgId == packet.MsgId
 
+class Pubrecs(MsgIdPackets):
+  msgType = PUBREC
 
-class Pubcomps(Packets):
+class Pubrels(MsgIdPackets):
+  msgType = PUBREL
 
-  def __init__(self, buffer = None):
-    self.mh = MessageHeaders(PUBCOMP)
-    self.MsgId = 0
-    if buffer != None:
-      self.unpack(buffer)
-
-  def pack(self):
-    return self.mh.pack(2) + writeInt16(self.MsgId)
+class Pubcomps(MsgIdPackets):
+  msgType = PUBCOMP
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == PUBCOMP
-    self.MsgId = readInt16(buffer[pos:])
-
-  def __str__(self):
-    return str(self.mh)+" , MsgId "+str(self.MsgId)
 
-  def __eq__(self, packet):
-    return Packets.__eq__(self, packet) and self.MsgId == packet.MsgId
-    
-    
 class Subscribes(Packets):
 
   def __init__(self, buffer = None):
@@ -637,44 +606,38 @@ class Subscribes(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = self.Flags.pack() + writeInt16(self.MsgId)
     if self.Flags.TopicIdType == TOPIC_PREDEFINED:
-      buffer += writeInt16(self.TopicId)
-    elif self.Flags.TopicIdType in [TOPIC_NORMAL, TOPIC_SHORTNAME]:
-      buffer += self.TopicName
-    return self.mh.pack(len(buffer)) + buffer
-
+      topic = writeInt16(self.TopicId)
+    else:
+      topic = self.TopicName
+    return self.encode((self.Flags.encode(), self.MsgId), topic)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == SUBSCRIBE
-    pos += self.Flags.unpack(buffer[pos:])
-    self.MsgId = readInt16(buffer[pos:])
-    pos += 2
+  def unpackFields(self, fields, data):
+    flags, self.MsgId = fields
+    self.Flags.decode(flags)
     self.TopicId = 0
     self.TopicName = ""
     if self.Flags.TopicIdType == TOPIC_PREDEFINED:
-      self.TopicId = readInt16(buffer[pos:])
-    elif self.Flags.TopicIdType in [TOPIC_NORMAL, TOPIC_SHORTNAME]:
-      self.TopicName = buffer[pos:pos+2]
+      self.TopicId = readInt16(data)
+    else:
+      self.TopicName = toText(data)
 
   def __str__(self):
     buffer = str(self.mh)+", Flags "+str(self.Flags)+", MsgId "+str(self.MsgId)
-    if self.Flags.TopicIdType == 0:
-      buffer += ", TopicName "+self.TopicName
-    elif self.Flags.TopicIdType == 1:
+    if self.Flags.TopicIdType == TOPIC_PREDEFINED:
       buffer += ", TopicId "+str(self.TopicId)
-    elif self.Flags.TopicIdType == 2:
-      buffer += ", TopicId "+self.TopicId
+    else:
+      buffer += ", TopicName "+self.TopicName
     return buffer
 
   def __eq__(self, packet):
-    if self.Flags.TopicIdType == 0:
-      rc = self.TopicName == packet.TopicName
-    else:
+    if not Packets.__eq__(self, packet):
+      return False
+    if self.Flags.TopicIdType == TOPIC_PREDEFINED:
       rc = self.TopicId == packet.TopicId
-    return Packets.__eq__(self, packet) and \
-         self.Flags == packet.Flags and \
+    else:
+      rc = self.TopicName == packet.TopicName
+    return self.Flags == packet.Flags and \
          self.MsgId == packet.MsgId and rc
 
 
@@ -690,18 +653,11 @@ class Subacks(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = self.Flags.pack() + writeInt16(self.TopicId) + writeInt16(self.MsgId) + chr(self.ReturnCode)
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.Flags.encode(), self.TopicId, self.MsgId, self.ReturnCode))
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == SUBACK
-    pos += self.Flags.unpack(buffer[pos:])
-    self.TopicId = readInt16(buffer[pos:])
-    pos += 2
-    self.MsgId = readInt16(buffer[pos:])
-    pos += 2
-    self.ReturnCode = ord(buffer[pos])
+  def unpackFields(self, fields, data):
+    flags, self.TopicId, self.MsgId, self.ReturnCode = fields
+    self.Flags.decode(flags)
 
   def __str__(self):
     return str(self.mh)+", Flags "+str(self.Flags)+", TopicId "+str(self.TopicId)+" , MsgId "+str(self.MsgId)+", ReturnCode "+str(self.ReturnCode)
@@ -714,52 +670,14 @@ class Subacks(Packets):
            self.ReturnCode == packet.ReturnCode
 
 
-class Unsubscribes(Packets):
+class Unsubscribes(Subscribes):
 
   def __init__(self, buffer = None):
+    Subscribes.__init__(self)
     self.mh = MessageHeaders(UNSUBSCRIBE)
-    self.Flags = Flags()
-    self.MsgId = 0 # 2 bytes
-    self.TopicId = 0 # 2 bytes
-    self.TopicName = ""
     if buffer != None:
       self.unpack(buffer)
 
-  def pack(self):
-    buffer = self.Flags.pack() + writeInt16(self.MsgId)
-    if self.Flags.TopicIdType == 0:
-      buffer += self.TopicName
-    elif self.Flags.TopicIdType == 1:
-      buffer += writeInt16(self.TopicId)
-    elif self.Flags.TopicIdType == 2:
-      buffer += self.TopicId
-    return self.mh.pack(len(buffer)) + buffer
-
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == UNSUBSCRIBE
-    pos += self.Flags.unpack(buffer[pos:])
-    self.MsgId = readInt16(buffer[pos:])
-    pos += 2
-    self.TopicId = 0
-    self.TopicName = ""
-    if self.Flags.TopicIdType == 0:
-      self.TopicName = buffer[pos:self.mh.Length]
-    elif self.Flags.TopicIdType == 1:
-      self.TopicId = readInt16(buffer[pos:])
-    elif self.Flags.TopicIdType == 3:
-      self.TopicId = buffer[pos:pos+2]
-
-  def __str__(self):
-    buffer = str(self.mh)+", Flags "+str(self.Flags)+", MsgId "+str(self.MsgId)
-    if self.Flags.TopicIdType == 0:
-      buffer += ", TopicName "+self.TopicName
-    elif self.Flags.TopicIdType == 1:
-      buffer += ", TopicId "+str(self.TopicId)
-    elif self.Flags.TopicIdType == 2:
-      buffer += ", TopicId "+self.TopicId
-    return buffer
-
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and \
          self.Flags == packet.Flags and \
@@ -767,27 +685,8 @@ class Unsubscribes(Packets):
          self.TopicId == packet.TopicId and \
          self.TopicName == packet.TopicName
 
-class Unsubacks(Packets):
-
-  def __init__(self, buffer = None):
-    self.mh = MessageHeaders(UNSUBACK)
-    self.MsgId = 0
-    if buffer != None:
-      self.unpack(buffer)
-
-  def pack(self):
-    return self.mh.pack(2) + writeInt16(self.MsgId)
-
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == UNSUBACK
-    self.MsgId = readInt16(buffer[pos:])
-
-  def __str__(self):
-    return str(self.mh)+" , MsgId "+str(self.MsgId)
-
-  def __eq__(self, packet):
-    return Packets.__eq__(self, packet) and self.MsgId == packet.MsgId
+class Unsubacks(MsgIdPackets):
+  msgType = UNSUBACK
 
 
 class Pingreqs(Packets):
@@ -799,18 +698,10 @@ class Pingreqs(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    if self.ClientId:
-      buf = self.mh.pack(len(self.ClientId)) + self.ClientId
-    else:
-      buf = self.mh.pack(0)
-    return buf
+    return self.encode((), self.ClientId or b"")
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == PINGREQ
-    self.ClientId = buffer[pos:self.mh.Length]
-    if self.ClientId == '':
-      self.ClientId = None
+  def unpackFields(self, fields, data):
+    self.ClientId = toText(data) if len(data) else None
 
   def __str__(self):
     buf = str(self.mh)
@@ -821,7 +712,7 @@ class Pingreqs(Packets):
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and \
            self.ClientId == packet.ClientId
-          
+
 
 class Pingresps(Packets):
 
@@ -830,10 +721,6 @@ class Pingresps(Packets):
     if buffer != None:
       self.unpack(buffer)
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == PINGRESP
-  
 class Disconnects(Packets):
 
   def __init__(self, buffer = None):
@@ -843,20 +730,10 @@ class Disconnects(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    if self.Duration:
-      buf = self.mh.pack(2) + writeInt16(self.Duration)
-    else:
-      buf = self.mh.pack(0)
-    return buf
+    return self.encode((), writeInt16(self.Duration) if self.Duration else b"")
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == DISCONNECT
-    buf = buffer[pos:self.mh.Length]
-    if buf == '':
-      self.Duration = None
-    else:
-      self.Duration = readInt16(buffer[pos:])
+  def unpackFields(self, fields, data):
+    self.Duration = readInt16(data) if len(data) else None
 
   def __str__(self):
     buf = str(self.mh)
@@ -867,57 +744,23 @@ class Disconnects(Packets):
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and \
            self.Duration == packet.Duration
-          
-class WillTopicUpds(Packets):
+
+class WillTopicUpds(WillTopics):
 
   def __init__(self, buffer = None):
+    WillTopics.__init__(self)
     self.mh = MessageHeaders(WILLTOPICUPD)
-    self.flags = Flags()
-    self.WillTopic = ""
     if buffer != None:
       self.unpack(buffer)
 
-  def pack(self):
-    buffer = self.flags.pack() + self.WillTopic
-    return self.mh.pack(len(buffer)) + buffer
-
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLTOPICUPD
-    pos += self.flags.unpack(buffer[pos:])
-    self.WillTopic = buffer[pos:self.mh.Length]
-
-  def __str__(self):
-    return str(self.mh)+", Flags "+str(self.flags)+", WillTopic "+self.WillTopic
-
-  def __eq__(self, packet):
-    return Packets.__eq__(self, packet) and \
-           self.flags == packet.flags and \
-           self.WillTopic == packet.WillTopic
-          
-class WillMsgUpds(Packets):
+class WillMsgUpds(WillMsgs):
 
   def __init__(self, buffer = None):
+    WillMsgs.__init__(self)
     self.mh = MessageHeaders(WILLMSGUPD)
-    self.WillMsg = ""
     if buffer != None:
       self.unpack(buffer)
 
-  def pack(self):
-    return self.mh.pack(len(self.WillMsg)) + self.WillMsg
-
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLMSGUPD
-    self.WillMsg = buffer[pos:self.mh.Length]
-
-  def __str__(self):
-    return str(self.mh)+", WillMsg "+self.WillMsg
-
-  def __eq__(self, packet):
-    return Packets.__eq__(self, packet) and \
-           self.WillMsg == packet.WillMsg
-          
 class WillTopicResps(Packets):
 
   def __init__(self, buffer = None):
@@ -927,13 +770,10 @@ class WillTopicResps(Packets):
       self.unpack(buffer)
 
   def pack(self):
-    buffer = writeInt16(self.ReturnCode)
-    return self.mh.pack(len(buffer)) + buffer
+    return self.encode((self.ReturnCode,))
 
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLTOPICRESP
-    self.ReturnCode = readInt16(buffer[pos:])
+  def unpackFields(self, fields, data):
+    self.ReturnCode, = fields
 
   def __str__(self):
     return str(self.mh)+", ReturnCode "+str(self.ReturnCode)
@@ -941,65 +781,53 @@ class WillTopicResps(Packets):
   def __eq__(self, packet):
     return Packets.__eq__(self, packet) and \
            self.ReturnCode == packet.ReturnCode
-          
-class WillMsgResps(Packets):
+
+class WillMsgResps(WillTopicResps):
 
   def __init__(self, buffer = None):
+    WillTopicResps.__init__(self)
     self.mh = MessageHeaders(WILLMSGRESP)
-    self.ReturnCode = 0
     if buffer != None:
       self.unpack(buffer)
 
-  def pack(self):
-    buffer = writeInt16(self.ReturnCode)
-    return self.mh.pack(len(buffer)) + buffer
-
-  def unpack(self, buffer):
-    pos = self.mh.unpack(buffer)
-    assert self.mh.MsgType == WILLMSGRESP
-    self.returnCode = readInt16(buffer[pos:])
-
-  def __str__(self):
-    return str(self.mh)+", ReturnCode "+str(self.ReturnCode)
-
-  def __eq__(self, packet):
-    return Packets.__eq__(self, packet) and \
-           self.ReturnCode == packet.ReturnCode
-
 objects = [Advertises, SearchGWs, GWInfos, None,
            Connects, Connacks,
-           WillTopicReqs, WillTopics, WillMsgReqs, WillMsgs, 
-           Registers, Regacks, 
+           WillTopicReqs, WillTopics, WillMsgReqs, WillMsgs,
+           Registers, Regacks,
            Publishes, Pubacks, Pubcomps, Pubrecs, Pubrels, None,
            Subscribes, Subacks, Unsubscribes, Unsubacks,
            Pingreqs, Pingresps, Disconnects, None,
            WillTopicUpds, WillTopicResps, WillMsgUpds, WillMsgResps]
 
-def unpackPacket((buffer, address)):
-  if MessageType(buffer) != None:
-    packet = objects[MessageType(buffer)]()
-    packet.unpack(buffer)
-  else:
-    packet = None
+def unpackPacket(datagram):
+  "decode a (buffer, address) pair from getPacket into a packet object"
+  if datagram == None:
+    return None, None
+  buffer, address = datagram
+  try:
+    length, msgtype, fields, data = decode(buffer)
+  except ValueError:
+    return None, address
+  packet = objects[msgtype]()
+  packet.mh.Length = length
+  packet.unpackFields(fields, data)
   return packet, address
 
 if __name__ == "__main__":
-  print "Object string representations"
+  print("Object string representations")
   for o in objects:
     if o:
-      print o()
-      
-  print "\nComparisons"
+      print(o())
+
+  print("\nComparisons")
   for o in [Flags] + objects:
     if o:
       o1 = o()
       o2 = o()
       o2.unpack(o1.pack())
       if o1 != o2:
-        print "error! ", str(o1.mh) if hasattr(o1, "mh") else o1.__class__.__name__
-        print str(o1)
-        print str(o2)
+        print("error! ", str(o1.mh) if hasattr(o1, "mh") else o1.__class__.__name__)
+        print(str(o1))
+        print(str(o2))
       else:
-        print "ok ", str(o1.mh) if hasattr(o1, "mh") else o1.__class__.__name__
-  
-
+        print("ok ", str(o1.mh) if hasattr(o1, "mh") else o1.__class__.__name__)
@@ -0,0 +1,256 @@
+# asyncio interface for MQTT-SN clients
+#
+# Each Client is a DatagramProtocol endpoint on the running event loop, so
+# one process can host many sensor sessions without a receiver thread per
+# client.  Packets are the same MQTTSN classes used by MQTTSNclient, and
+# callbacks use the same interface as MQTTSNclient.Callback.
+
+import asyncio, traceback
+import MQTTSN
+
+debug = False
+
+
+class Protocol(asyncio.DatagramProtocol):
+
+  def __init__(self, client):
+    self.client = client
+
+  def connection_made(self, transport):
+    self.client.transport = transport
+
+  def datagram_received(self, data, address):
+    try:
+      packet, address = MQTTSN.unpackPacket((data, address))
+    except Exception:
+      traceback.print_exc()
+      return
+    if packet != None:
+      self.client.received(packet, address)
+
+  def error_received(self, exc):
+    if debug:
+      print("error received", exc)
+
+  def connection_lost(self, exc):
+    self.client.lost(exc)
+
+
+class Client:
+
+  def __init__(self, clientid, host="localhost", port=1883, timeout=5.0):
+    self.clientid = clientid
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.msgid = 1
+    self.callback = None
+    self.transport = None
+
+    # futures awaiting an acknowledgement, keyed by (MsgType, MsgId);
+    # a MsgId of None matches any packet of that type
+    self.requests = {}
+
+    self.inMsgs = {}
+    self.outMsgs = {}
+
+  def registerCallback(self, callback):
+    self.callback = callback
+
+  def __nextMsgid(self):
+    if len(self.outMsgs) + len(self.requests) >= 65535:
+      raise Exception("No slots left!!")
+    while True:
+      self.msgid = self.msgid + 1 if self.msgid < 65535 else 1
+      if self.msgid not in self.outMsgs and \
+         not any(key[1] == self.msgid for key in self.requests):
+        return self.msgid
+
+  def send(self, packet):
+    self.transport.sendto(packet.pack())
+
+  async def request(self, packet, msgType, msgId=None):
+    "send a packet and wait for the packet that acknowledges it"
+    future = asyncio.get_running_loop().create_future()
+    self.requests[(msgType, msgId)] = future
+    try:
+      self.send(packet)
+      return await asyncio.wait_for(future, self.timeout)
+    finally:
+      if self.requests.get((msgType, msgId)) is future:
+        del self.requests[(msgType, msgId)]
+
+  async def connect(self, cleansession=True):
+    if self.transport == None:
+      loop = asyncio.get_running_loop()
+      await loop.create_datagram_endpoint(lambda: Protocol(self),
+                                          remote_addr=(self.host, self.port))
+    connect = MQTTSN.Connects()
+    connect.ClientId = self.clientid
+    connect.Flags.CleanSession = cleansession
+    response = await self.request(connect, MQTTSN.CONNACK)
+    return response.ReturnCode
+
+  async def subscribe(self, topic, qos=2):
+    subscribe = MQTTSN.Subscribes()
+    subscribe.MsgId = self.__nextMsgid()
+    if not isinstance(topic, int):
+      subscribe.TopicName = topic
+      if len(topic) > 2:
+        subscribe.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
+      else:
+        subscribe.Flags.TopicIdType = MQTTSN.TOPIC_SHORTNAME
+    else:
+      subscribe.TopicId = topic # should be int
+      subscribe.Flags.TopicIdType = MQTTSN.TOPIC_PREDEFINED
+    subscribe.Flags.QoS = qos
+    msg = await self.request(subscribe, MQTTSN.SUBACK, subscribe.MsgId)
+    return msg.ReturnCode, msg.TopicId
+
+  async def unsubscribe(self, topic):
+    unsubscribe = MQTTSN.Unsubscribes()
+    unsubscribe.MsgId = self.__nextMsgid()
+    if not isinstance(topic, int):
+      unsubscribe.TopicName = topic
+      if len(topic) > 2:
+        unsubscribe.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
+      else:
+        unsubscribe.Flags.TopicIdType = MQTTSN.TOPIC_SHORTNAME
+    else:
+      unsubscribe.TopicId = topic
+      unsubscribe.Flags.TopicIdType = MQTTSN.TOPIC_PREDEFINED
+    await self.request(unsubscribe, MQTTSN.UNSUBACK, unsubscribe.MsgId)
+
+  async def register(self, topicName):
+    register = MQTTSN.Registers()
+    register.TopicName = topicName
+    register.MsgId = self.__nextMsgid()
+    msg = await self.request(register, MQTTSN.REGACK, register.MsgId)
+    return msg.TopicId
+
+  async def publish(self, topic, payload, qos=0, retained=False):
+    """publish, returning the message id once the gateway has acknowledged
+    a QoS 1 or 2 message"""
+    publish = MQTTSN.Publishes()
+    publish.Flags.QoS = qos
+    publish.Flags.Retain = retained
+    if not isinstance(topic, int):
+      publish.Flags.TopicIdType = MQTTSN.TOPIC_SHORTNAME
+      publish.TopicName = topic
+    else:
+      publish.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
+      publish.TopicId = topic
+    publish.Data = payload
+    if qos in [-1, 0]:
+      publish.MsgId = 0
+      self.send(publish)
+      return publish.MsgId
+    publish.MsgId = self.__nextMsgid()
+    self.outMsgs[publish.MsgId] = publish
+    try:
+      if qos == 1:
+        await self.request(publish, MQTTSN.PUBACK, publish.MsgId)
+      else:
+        await self.request(publish, MQTTSN.PUBREC, publish.MsgId)
+        pubrel = MQTTSN.Pubrels()
+        pubrel.MsgId = publish.MsgId
+        await self.request(pubrel, MQTTSN.PUBCOMP, publish.MsgId)
+    finally:
+      del self.outMsgs[publish.MsgId]
+    if hasattr(self.callback, "published"):
+      self.callback.published(publish.MsgId)
+    return publish.MsgId
+
+  async def disconnect(self):
+    disconnect = MQTTSN.Disconnects()
+    try:
+      await self.request(disconnect, MQTTSN.DISCONNECT)
+    finally:
+      self.transport.close()
+      self.transport = None
+
+  def lost(self, exc):
+    for future in self.requests.values():
+      if not future.done():
+        future.set_exception(exc or ConnectionError("connection closed"))
+    if exc != None and hasattr(self.callback, "connectionLost"):
+      self.callback.connectionLost(exc)
+
+  def received(self, packet, address):
+    if debug:
+      print(packet)
+
+    msgType = packet.mh.MsgType
+    future = self.requests.get((msgType, getattr(packet, "MsgId", None)))
+    if future == None:
+      future = self.requests.get((msgType, None))
+    if future != None:
+      if not future.done():
+        future.set_result(packet)
+
+    elif msgType == MQTTSN.ADVERTISE:
+      if hasattr(self.callback, "advertise"):
+        self.callback.advertise(address, packet.GwId, packet.Duration)
+
+    elif msgType == MQTTSN.REGISTER:
+      if hasattr(self.callback, "register"):
+        self.callback.register(packet.TopicId, packet.TopicName)
+      regack = MQTTSN.Regacks()
+      regack.TopicId = packet.TopicId
+      regack.MsgId = packet.MsgId
+      self.send(regack)
+
+    elif msgType == MQTTSN.PUBLISH:
+      qos = packet.Flags.QoS
+      if qos in [0, 3]:
+        self.messageArrived(packet, -1 if qos == 3 else 0)
+      elif qos == 1:
+        if self.messageArrived(packet, 1):
+          puback = MQTTSN.Pubacks()
+          puback.TopicId = packet.TopicId
+          puback.MsgId = packet.MsgId
+          self.send(puback)
+      elif qos == 2:
+        self.inMsgs[packet.MsgId] = packet
+        pubrec = MQTTSN.Pubrecs()
+        pubrec.MsgId = packet.MsgId
+        self.send(pubrec)
+
+    elif msgType == MQTTSN.PUBREL:
+      "release QOS 2 publication to client, & send PUBCOMP"
+      pub = self.inMsgs.get(packet.MsgId)
+      if pub != None and self.messageArrived(pub, 2):
+        del self.inMsgs[packet.MsgId]
+        pubcomp = MQTTSN.Pubcomps()
+        pubcomp.MsgId = packet.MsgId
+        self.send(pubcomp)
+
+    elif debug:
+      print("unexpected packet", packet)
+
+  def messageArrived(self, packet, qos):
+    if self.callback == None:
+      return True
+    if packet.Flags.TopicIdType == MQTTSN.TOPIC_SHORTNAME:
+      topic = packet.TopicName
+    else:
+      topic = packet.TopicId
+    return self.callback.messageArrived(topic, packet.Data, qos,
+                                        packet.Flags.Retain, packet.MsgId)
+
+
+if __name__ == "__main__":
+  import MQTTSNclient
+
+  async def main():
+    aclient = Client("linh", port=1885)
+    aclient.registerCallback(MQTTSNclient.Callback())
+    await aclient.connect()
+
+    rc, topic1 = await aclient.subscribe("topic1")
+    print("topic id for topic1 is", topic1)
+    await aclient.publish(topic1, "aaaa", qos=1)
+    await aclient.unsubscribe("topic1")
+    await aclient.disconnect()
+
+  asyncio.run(main())
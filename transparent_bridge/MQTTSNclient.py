@@ -16,7 +16,9 @@
  *******************************************************************************/
 """
 
-import MQTTSN, socket, time, MQTTSNinternal, thread, types, sys, struct
+from __future__ import print_function
+
+import MQTTSN, socket, MQTTSNinternal, threading, struct
 
 
 class Callback:
@@ -26,32 +28,38 @@ class Callback:
     self.registered = {}
 
   def connectionLost(self, cause):
-    print "default connectionLost", cause
+    print("default connectionLost", cause)
     self.events.append("disconnected")
 
   def messageArrived(self, topicName, payload, qos, retained, msgid):
-    print "default publishArrived", topicName, payload, qos, retained, msgid
+    print("default publishArrived", topicName, payload, qos, retained, msgid)
     return True
 
   def deliveryComplete(self, msgid):
-    print "default deliveryComplete"
+    print("default deliveryComplete")
   
   def advertise(self, address, gwid, duration):
-    print "advertise", address, gwid, duration
+    print("advertise", address, gwid, duration)
 
-  def register(self, topicid, topicName):
+  def register(self, topicId, topicName):
     self.registered[topicId] = topicName
 
 
 class Client:
 
-  def __init__(self, clientid, host="localhost", port=1883):
+  def __init__(self, clientid, host="localhost", port=1883, window=10,
+               retryInterval=2.0, maxRetries=5, connectTimeout=5.0):
     self.clientid = clientid
     self.host = host
     self.port = port
-    self.msgid = 1
+    self.window = window                # QoS 1 and 2 publishes in flight
+    self.retryInterval = retryInterval  # seconds before the first retransmission
+    self.maxRetries = maxRetries
+    self.connectTimeout = connectTimeout  # seconds to wait for the CONNACK
     self.callback = None
+    self.sock = None
     self.__receiver = None
+    self.receiverThread = None
     
   def start(self):
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -67,19 +75,7 @@ class Client:
     self.stopReceiver()
 
   def __nextMsgid(self):
-    def getWrappedMsgid():
-      id = self.msgid + 1
-      if id == 65535:
-        id = 1
-      return id
-
-    if len(self.__receiver.outMsgs) >= 65535:
-      raise "No slots left!!"
-    else:
-      self.msgid = getWrappedMsgid()
-      while self.__receiver.outMsgs.has_key(self.msgid):
-        self.msgid = getWrappedMsgid()
-    return self.msgid
+    return self.__receiver.msgids.allocate()
 
 
   def registerCallback(self, callback):
@@ -87,35 +83,58 @@ class Client:
 
 
   def connect(self, cleansession=True):
+    if self.__receiver:
+      self.stopReceiver() # a reconnect: release the previous socket
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    #self.sock.settimeout(5.0)
-
-    self.sock.connect((self.host, self.port))
-
-    connect = MQTTSN.Connects()
-    connect.ClientId = self.clientid
-    connect.CleanSession = cleansession
-    connect.KeepAliveTimer = 0
-    self.sock.send(connect.pack())
-
-    response, address = MQTTSN.unpackPacket(MQTTSN.getPacket(self.sock))
-    assert response.mh.MsgType == MQTTSN.CONNACK
+    # an unresponsive gateway raises socket.timeout instead of blocking
+    # the caller forever; the receiver thread reads without a timeout
+    self.sock.settimeout(self.connectTimeout)
+
+    try:
+      self.sock.connect((self.host, self.port))
+
+      connect = MQTTSN.Connects()
+      connect.ClientId = self.clientid
+      connect.CleanSession = cleansession
+      connect.KeepAliveTimer = 0
+      self.sock.send(connect.pack())
+
+      response, address = MQTTSN.unpackPacket(MQTTSN.getPacket(self.sock))
+      assert response.mh.MsgType == MQTTSN.CONNACK
+    except:
+      self.sock.close()
+      raise
+    self.sock.settimeout(None)
     
     self.startReceiver()
 
     
   def startReceiver(self):
-    self.__receiver = MQTTSNinternal.Receivers(self.sock)
+    if self.__receiver:
+      self.__receiver.stop()
+    self.__receiver = MQTTSNinternal.Receivers(self.sock, window=self.window,
+      retryInterval=self.retryInterval, maxRetries=self.maxRetries)
     if self.callback:
-      id = thread.start_new_thread(self.__receiver, (self.callback,))
+      self.receiverThread = threading.Thread(target=self.__receiver, args=(self.callback,))
+      self.receiverThread.daemon = True
+      self.receiverThread.start()
+
+  def receiverAlive(self):
+    return self.receiverThread != None and self.receiverThread.is_alive()
+
+  def drain(self, timeout=None):
+    "wait for in-flight QoS 1 and 2 publishes to be acknowledged"
+    return self.__receiver.drain(timeout)
 
 
   def waitfor(self, msgType, msgId=None):
-    if self.__receiver:
+    if self.callback:
       msg = self.__receiver.waitfor(msgType, msgId)
     else:
+      # no receiver thread, so read packets here until the one we want
       msg = self.__receiver.receive()
-      while msg.mh.MsgType != msgType and (msgId == None or msgId == msg.MsgId):
+      while not isinstance(msg, MQTTSN.Packets) or msg.mh.MsgType != msgType or \
+            (msgId != None and msgId != msg.MsgId):
         msg = self.__receiver.receive()
     return msg
 
@@ -123,7 +142,7 @@ class Client:
   def subscribe(self, topic, qos=2):
     subscribe = MQTTSN.Subscribes()
     subscribe.MsgId = self.__nextMsgid()
-    if type(topic) == types.StringType:
+    if not isinstance(topic, int):
       subscribe.TopicName = topic
       if len(topic) > 2:
         subscribe.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
@@ -133,66 +152,87 @@ class Client:
       subscribe.TopicId = topic # should be int
       subscribe.Flags.TopicIdType = MQTTSN.TOPIC_PREDEFINED
     subscribe.Flags.QoS = qos
-    if self.__receiver:
-      self.__receiver.lookfor(MQTTSN.SUBACK)
+    self.__receiver.lookfor(MQTTSN.SUBACK, subscribe.MsgId)
     self.sock.send(subscribe.pack())
     msg = self.waitfor(MQTTSN.SUBACK, subscribe.MsgId)
+    self.__receiver.msgids.release(subscribe.MsgId)
+    if msg == None:
+      raise socket.timeout("no SUBACK for %s" % topic)
     return msg.ReturnCode, msg.TopicId
 
 
-  def unsubscribe(self, topics):
+  def unsubscribe(self, topic):
     unsubscribe = MQTTSN.Unsubscribes()
     unsubscribe.MsgId = self.__nextMsgid()
-    unsubscribe.data = topics
-    if self.__receiver:
-      self.__receiver.lookfor(MQTTSN.UNSUBACK)
+    if not isinstance(topic, int):
+      unsubscribe.TopicName = topic
+      if len(topic) > 2:
+        unsubscribe.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
+      else:
+        unsubscribe.Flags.TopicIdType = MQTTSN.TOPIC_SHORTNAME
+    else:
+      unsubscribe.TopicId = topic # should be int
+      unsubscribe.Flags.TopicIdType = MQTTSN.TOPIC_PREDEFINED
+    self.__receiver.lookfor(MQTTSN.UNSUBACK, unsubscribe.MsgId)
     self.sock.send(unsubscribe.pack())
     msg = self.waitfor(MQTTSN.UNSUBACK, unsubscribe.MsgId)
+    self.__receiver.msgids.release(unsubscribe.MsgId)
   
   
   def register(self, topicName):
     register = MQTTSN.Registers()
     register.TopicName = topicName
-    if self.__receiver:
-      self.__receiver.lookfor(MQTTSN.REGACK)
+    register.MsgId = self.__nextMsgid()
+    self.__receiver.lookfor(MQTTSN.REGACK, register.MsgId)
     self.sock.send(register.pack())
     msg = self.waitfor(MQTTSN.REGACK, register.MsgId)
+    self.__receiver.msgids.release(register.MsgId)
     return msg.TopicId
 
 
-  def publish(self, topic, payload, qos=0, retained=False):
+  def publish(self, topic, payload, qos=0, retained=False, onComplete=None):
+    """QoS 1 and 2 publishes block while the in-flight window is full and
+    are retransmitted until acknowledged.  onComplete(msgid, packet) is
+    called with the final ack, or with None if the gateway never answered"""
     publish = MQTTSN.Publishes()
     publish.Flags.QoS = qos
     publish.Flags.Retain = retained
-    if type(topic) == types.StringType:
+    if not isinstance(topic, int):
       publish.Flags.TopicIdType = MQTTSN.TOPIC_SHORTNAME
       publish.TopicName = topic
     else:
       publish.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
       publish.TopicId = topic
+    publish.Data = payload
     if qos in [-1, 0]:
       publish.MsgId = 0
+      self.sock.send(publish.pack())
     else:
-      publish.MsgId = self.__nextMsgid()
-      print "MsgId", publish.MsgId
-      self.__receiver.outMsgs[publish.MsgId] = publish
-    publish.Data = payload
-    self.sock.send(publish.pack())
+      callback = None
+      if onComplete:
+        callback = lambda delivery: onComplete(publish.MsgId, delivery.packet)
+      self.__receiver.publish(publish, callback)
     return publish.MsgId
   
 
   def disconnect(self):
     disconnect = MQTTSN.Disconnects()
-    if self.__receiver:
-      self.__receiver.lookfor(MQTTSN.DISCONNECT)
+    self.__receiver.lookfor(MQTTSN.DISCONNECT)
     self.sock.send(disconnect.pack())
     msg = self.waitfor(MQTTSN.DISCONNECT)
     
 
   def stopReceiver(self):
+    self.__receiver.stop()
+    try:
+      # closing alone does not wake a thread blocked in recvfrom
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
     self.sock.close() # this will stop the receiver too
-    assert self.__receiver.inMsgs == {}
-    assert self.__receiver.outMsgs == {}
+    if self.__receiver.inMsgs or self.__receiver.outMsgs:
+      print("stopping with", len(self.__receiver.inMsgs), "incoming and",
+            len(self.__receiver.outMsgs), "outgoing messages unacknowledged")
     self.__receiver = None
 
   def receive(self):
@@ -203,7 +243,7 @@ def publish(topic, payload, retained=False, port=1883, host="localhost"):
   publish = MQTTSN.Publishes()
   publish.Flags.QoS = 3
   publish.Flags.Retain = retained  
-  if type(topic) == types.StringType:
+  if not isinstance(topic, int):
     if len(topic) > 2:
       publish.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
       publish.TopicId = len(topic)
@@ -215,7 +255,6 @@ def publish(topic, payload, retained=False, port=1883, host="localhost"):
     publish.Flags.TopicIdType = MQTTSN.TOPIC_NORMAL
     publish.TopicId = topic
   publish.MsgId = 0
-  print "payload", payload
   publish.Data = payload
   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
   sock.sendto(publish.pack(), (host, port))
@@ -263,9 +302,9 @@ if __name__ == "__main__":
 	aclient.connect()
 
 	rc, topic1 = aclient.subscribe("topic1")
-	print "topic id for topic1 is", topic1
+	print("topic id for topic1 is", topic1)
 	rc, topic2 = aclient.subscribe("topic2")
-	print "topic id for topic2 is", topic2
+	print("topic id for topic2 is", topic2)
 	aclient.publish(topic1, "aaaa", qos=0)
 	aclient.publish(topic2, "bbbb", qos=0)
 	aclient.unsubscribe("topic1")
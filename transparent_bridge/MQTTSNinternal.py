@@ -16,128 +16,347 @@
  *******************************************************************************/
 """
 
-import MQTTSN, time, sys, socket, traceback
+from __future__ import print_function
+
+import MQTTSN, sys, socket, traceback, threading, time, collections
 
 debug = False
 
+class Requests:
+  """a request waiting for its acknowledgement from the gateway.  The
+  packet is None if the request was abandoned"""
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.packet = None
+    self.callbacks = []
+    self.lock = threading.Lock()
+
+  def complete(self, packet):
+    with self.lock:
+      self.packet = packet
+      self.event.set()
+      callbacks, self.callbacks = self.callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+  def done(self):
+    return self.event.is_set()
+
+  def addCallback(self, callback):
+    "call callback(request) on completion, or now if already complete"
+    with self.lock:
+      if not self.event.is_set():
+        self.callbacks.append(callback)
+        return
+    callback(self)
+
+  def wait(self, timeout=None):
+    self.event.wait(timeout)
+    return self.packet
+
+
+class MsgIds:
+  """O(1) allocator of message ids 1..65535.  Every id is handed out once
+  before any is reused, and then the one freed longest ago comes first, so
+  a late duplicate ack of a retransmitted publish does not complete a new
+  publish that got its id"""
+
+  def __init__(self):
+    self.free = collections.deque()
+    self.unused = 1
+    self.lock = threading.Lock()
+
+  def allocate(self):
+    with self.lock:
+      if self.unused <= 65535:
+        self.unused += 1
+        return self.unused - 1
+      if self.free:
+        return self.free.popleft()
+      raise Exception("No slots left!!")
+
+  def release(self, msgid):
+    with self.lock:
+      self.free.append(msgid)
+
+
+class TimerWheels:
+  """hashed timer wheel: scheduling and cancelling are O(1), and each tick
+  only looks at the timers in one slot.  expired(key) is called on the
+  wheel's own thread"""
+
+  def __init__(self, expired, tick=0.1, slots=512):
+    self.expired = expired
+    self.tick = tick
+    self.slots = [{} for i in range(slots)] # key -> remaining rounds
+    self.where = {}                          # key -> slot index
+    self.current = 0
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def schedule(self, key, delay):
+    ticks = max(1, int(delay / self.tick + 0.5))
+    with self.lock:
+      self.__cancel(key)
+      index = (self.current + ticks) % len(self.slots)
+      self.slots[index][key] = (ticks - 1) // len(self.slots)
+      self.where[key] = index
+
+  def cancel(self, key):
+    with self.lock:
+      self.__cancel(key)
+
+  def __cancel(self, key):
+    index = self.where.pop(key, None)
+    if index != None:
+      del self.slots[index][key]
+
+  def advance(self):
+    with self.lock:
+      self.current = (self.current + 1) % len(self.slots)
+      slot = self.slots[self.current]
+      due = [key for key, rounds in slot.items() if rounds == 0]
+      for key in slot:
+        slot[key] -= 1
+      for key in due:
+        del slot[key]
+        del self.where[key]
+    for key in due:
+      try:
+        self.expired(key)
+      except:
+        traceback.print_exc()
+
+  def run(self):
+    deadline = time.time()
+    while not self.stopped.is_set():
+      deadline += self.tick
+      self.stopped.wait(max(0, deadline - time.time()))
+      self.advance()
+
+  def stop(self):
+    self.stopped.set()
+
+
 class Receivers:
 
-  def __init__(self, socket):
-    print "initializing receiver"
+  def __init__(self, socket, window=10, retryInterval=2.0, maxRetryInterval=30.0, maxRetries=5):
+    print("initializing receiver")
     self.socket = socket
     self.connected = False
-    self.observe = None
-    self.observed = []
+    self.running = True
+
+    # requests awaiting an acknowledgement, keyed by (MsgType, MsgId);
+    # a MsgId of None matches any packet of that type
+    self.requests = {}
+    self.requestsLock = threading.Lock()
 
     self.inMsgs = {}
     self.outMsgs = {}
 
+    # QoS 1 and 2 publishes in flight: the window bounds how many, and
+    # each is retransmitted with exponential backoff until acknowledged
+    self.msgids = MsgIds()
+    self.window = threading.BoundedSemaphore(window)
+    self.retryInterval = retryInterval
+    self.maxRetryInterval = maxRetryInterval
+    self.maxRetries = maxRetries
+    self.deliveries = {}   # msgid -> Requests
+    self.retries = {}      # msgid -> retransmissions so far
+    self.released = set() # QoS 2 msgids for which PUBREL has been sent
+    self.outLock = threading.RLock()
+    self.outIdle = threading.Condition(self.outLock)
+    self.timers = TimerWheels(self.retransmit)
+
     self.puback = MQTTSN.Pubacks()
     self.pubrec = MQTTSN.Pubrecs()
     self.pubrel = MQTTSN.Pubrels()
     self.pubcomp = MQTTSN.Pubcomps()
 
-  def lookfor(self, msgType):
-    self.observe = msgType
-
-  def waitfor(self, msgType, msgId=None):
-    msg = None
-    count = 0
-    while True:
-      while len(self.observed) > 0:
-        msg = self.observed.pop(0)
-        if msg.mh.MsgType == msgType and (msgId == None or msg.MsgId == msgId):
-          break
-        else:
-          msg = None
-      if msg != None:
-        break
-      time.sleep(0.2)
-      count += 1
-      if count == 25:
-        msg = None
-        break
-    self.observe = None
+  def lookfor(self, msgType, msgId=None):
+    "register interest in a packet before sending the request it answers"
+    request = Requests()
+    with self.requestsLock:
+      self.requests[(msgType, msgId)] = request
+    return request
+
+  def waitfor(self, msgType, msgId=None, timeout=5.0):
+    """wait for a packet registered with lookfor, returning None on timeout.
+    The request stays registered until here, so its packet is never lost
+    even when it arrives before we start waiting"""
+    with self.requestsLock:
+      request = self.requests.get((msgType, msgId))
+    if request == None:
+      request = self.lookfor(msgType, msgId)
+    msg = request.wait(timeout)
+    with self.requestsLock:
+      if self.requests.get((msgType, msgId)) is request:
+        del self.requests[(msgType, msgId)]
     return msg
 
+  def observed(self, packet):
+    "complete the request waiting for this packet, if there is one"
+    msgType = packet.mh.MsgType
+    with self.requestsLock:
+      request = self.requests.get((msgType, getattr(packet, "MsgId", None)))
+      if request == None:
+        request = self.requests.get((msgType, None))
+    if request == None:
+      return False
+    if debug:
+      print("observed", packet)
+    request.complete(packet)
+    return True
+
+  def publish(self, publish, callback=None):
+    """send a QoS 1 or 2 publish once there is room in the window, giving
+    it a message id; returns the Requests completed by its last ack"""
+    self.window.acquire()
+    publish.MsgId = self.msgids.allocate()
+    delivery = Requests()
+    if callback:
+      # before sending: the ack may arrive before publish returns
+      delivery.addCallback(callback)
+    with self.outLock:
+      self.outMsgs[publish.MsgId] = publish
+      self.deliveries[publish.MsgId] = delivery
+      self.retries[publish.MsgId] = 0
+      self.socket.send(publish.pack())
+      self.timers.schedule(publish.MsgId, self.retryInterval)
+    return delivery
+
+  def retransmit(self, msgid):
+    "retry timer expired: resend the PUBLISH or PUBREL, or give up"
+    with self.outLock:
+      if msgid not in self.outMsgs:
+        return
+      retries = self.retries[msgid] + 1
+      if retries > self.maxRetries:
+        print("giving up on message id", msgid)
+        self.delivered(msgid, None)
+        return
+      self.retries[msgid] = retries
+      if msgid in self.released:
+        pubrel = MQTTSN.Pubrels()
+        pubrel.MsgId = msgid
+        self.socket.send(pubrel.pack())
+      else:
+        publish = self.outMsgs[msgid]
+        publish.Flags.DUP = True
+        self.socket.send(publish.pack())
+      self.timers.schedule(msgid, min(self.retryInterval * 2 ** retries, self.maxRetryInterval))
+
+  def delivered(self, msgid, packet):
+    "release the message id and window slot of a finished publish"
+    with self.outLock:
+      if msgid not in self.outMsgs:
+        return None
+      self.timers.cancel(msgid)
+      del self.outMsgs[msgid]
+      del self.retries[msgid]
+      self.released.discard(msgid)
+      delivery = self.deliveries.pop(msgid)
+      if not self.outMsgs:
+        self.outIdle.notify_all()
+    self.msgids.release(msgid)
+    self.window.release()
+    delivery.complete(packet)
+    return delivery
+
+  def drain(self, timeout=None):
+    "wait until no publishes are in flight, returning False on timeout"
+    deadline = None if timeout == None else time.time() + timeout
+    with self.outLock:
+      while self.outMsgs:
+        remaining = None if deadline == None else deadline - time.time()
+        if remaining != None and remaining <= 0:
+          return False
+        self.outIdle.wait(remaining)
+    return True
+
+  def stop(self):
+    self.running = False
+    self.timers.stop()
+
   def receive(self, callback=None):
     packet = None
     try:
       packet, address = MQTTSN.unpackPacket(MQTTSN.getPacket(self.socket))
-    except:
-      if sys.exc_info()[0] != socket.timeout:
-        print "unexpected exception", sys.exc_info()
-        raise sys.exc_info()
+    except socket.timeout:
+      pass
     if packet == None:
-      time.sleep(0.1)
       return
     elif debug:
-      print packet
+      print(packet)
 
-    if self.observe == packet.mh.MsgType:
-      print "observed", packet
-      self.observed.append(packet)
-        
-    elif packet.mh.MsgType == MQTTSN.ADVERTISE:
+    if self.observed(packet):
+      return packet
+
+    if packet.mh.MsgType == MQTTSN.ADVERTISE:
       if hasattr(callback, "advertise"):
         callback.advertise(address, packet.GwId, packet.Duration)
 
     elif packet.mh.MsgType == MQTTSN.REGISTER:
       if callback and hasattr(callback, "register"):
-        callback.register(packet.TopicId, packet.Topicname)
+        callback.register(packet.TopicId, packet.TopicName)
 
     elif packet.mh.MsgType == MQTTSN.PUBACK:
       "check if we are expecting a puback"
-      if self.outMsgs.has_key(packet.MsgId) and \
-        self.outMsgs[packet.MsgId].Flags.QoS == 1:
-        del self.outMsgs[packet.MsgId]
+      publish = self.outMsgs.get(packet.MsgId)
+      if publish != None and publish.Flags.QoS == 1:
+        self.delivered(packet.MsgId, packet)
         if hasattr(callback, "published"):
           callback.published(packet.MsgId)
-      else:
-        raise Exception("No QoS 1 message with message id "+str(packet.MsgId)+" sent")
+      elif debug:
+        print("No QoS 1 message with message id "+str(packet.MsgId)+" sent")
 
     elif packet.mh.MsgType == MQTTSN.PUBREC:
-      if self.outMsgs.has_key(packet.MsgId):
-        self.pubrel.MsgId = packet.MsgId
-        self.socket.send(self.pubrel.pack())
-      else:
-        raise Exception("PUBREC received for unknown msg id "+ \
-                    str(packet.MsgId))
+      with self.outLock:
+        if packet.MsgId in self.outMsgs:
+          self.released.add(packet.MsgId)
+          self.retries[packet.MsgId] = 0
+          self.timers.schedule(packet.MsgId, self.retryInterval)
+          self.pubrel.MsgId = packet.MsgId
+          self.socket.send(self.pubrel.pack())
+        elif debug:
+          print("PUBREC received for unknown msg id "+str(packet.MsgId))
 
     elif packet.mh.MsgType == MQTTSN.PUBREL:
       "release QOS 2 publication to client, & send PUBCOMP"
       msgid = packet.MsgId
-      if not self.inMsgs.has_key(msgid):
+      if msgid not in self.inMsgs:
         pass # what should we do here?
       else:
         pub = self.inMsgs[packet.MsgId]
         if callback == None or \
-           callback.messageArrived(pub.TopicName, pub.Data, 2, pub.Flags.Retain, pub.MsgId):
+           callback.messageArrived(self.topicOf(pub), pub.Data, 2, pub.Flags.Retain, pub.MsgId):
           del self.inMsgs[packet.MsgId]
           self.pubcomp.MsgId = packet.MsgId
           self.socket.send(self.pubcomp.pack())
         if callback == None:
-          return (pub.TopicName, pub.Data, 2, pub.Flags.Retain, pub.MsgId)
+          return (self.topicOf(pub), pub.Data, 2, pub.Flags.Retain, pub.MsgId)
 
     elif packet.mh.MsgType == MQTTSN.PUBCOMP:
       "finished with this message id"
-      if self.outMsgs.has_key(packet.MsgId):
-        del self.outMsgs[packet.MsgId]
+      if self.delivered(packet.MsgId, packet):
         if hasattr(callback, "published"):
           callback.published(packet.MsgId)
-      else:
-        raise Exception("PUBCOMP received for unknown msg id "+ \
-                    str(packet.MsgId))
+      elif debug:
+        print("PUBCOMP received for unknown msg id "+str(packet.MsgId))
 
     elif packet.mh.MsgType == MQTTSN.PUBLISH:
       "finished with this message id"
       if packet.Flags.QoS in [0, 3]:
         qos = packet.Flags.QoS
-        topicname = packet.TopicName
+        topicname = self.topicOf(packet)
         data = packet.Data
         if qos == 3:
           qos = -1
-          if packet.Flags.TopicIdType == MQTTSN.TOPICID:
+          if packet.Flags.TopicIdType == MQTTSN.TOPIC_NORMAL:
             topicname = packet.Data[:packet.TopicId]
             data = packet.Data[packet.TopicId:]
         if callback == None:
@@ -146,10 +365,10 @@ class Receivers:
           callback.messageArrived(topicname, data, qos, packet.Flags.Retain, packet.MsgId)
       elif packet.Flags.QoS == 1:
         if callback == None:
-          return (packet.topicName, packet.Data, 1,
+          return (self.topicOf(packet), packet.Data, 1,
                            packet.Flags.Retain, packet.MsgId)
         else:
-          if callback.messageArrived(packet.TopicName, packet.Data, 1,
+          if callback.messageArrived(self.topicOf(packet), packet.Data, 1,
                            packet.Flags.Retain, packet.MsgId):
             self.puback.MsgId = packet.MsgId
             self.socket.send(self.puback.pack())
@@ -162,11 +381,17 @@ class Receivers:
       raise Exception("Unexpected packet"+str(packet))
     return packet
 
+  def topicOf(self, packet):
+    "the name of a short topic, else the topic id, as MQTTSNasync passes it"
+    if packet.Flags.TopicIdType == MQTTSN.TOPIC_SHORTNAME:
+      return packet.TopicName
+    return packet.TopicId
+
   def __call__(self, callback):
     try:
-      while True:
+      while self.running:
         self.receive(callback)
     except:
       if sys.exc_info()[0] != socket.error:
-        print "unexpected exception", sys.exc_info()
+        print("unexpected exception", sys.exc_info())
         traceback.print_exc()
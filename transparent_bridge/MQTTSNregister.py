@@ -16,6 +16,8 @@
  *******************************************************************************/
 """
 
+from __future__ import print_function
+
 import MQTTSNclient
 
 aclient = MQTTSNclient.Client("register", port=1885)
@@ -23,8 +25,8 @@ aclient.registerCallback(MQTTSNclient.Callback())
 
 aclient.connect()
 result = aclient.register("jkjkjkjkj")
-print "result from register 1 is", result
+print("result from register 1 is", result)
 result = aclient.register("jkjkjkjkj")
-print "result from register 1 is", result
+print("result from register 1 is", result)
 result = aclient.register("jkjkjkjkj2")
-print "result from register 2 is", result
+print("result from register 2 is", result)
@@ -0,0 +1,75 @@
+# Shared, lazily created AWS session and resources.
+#
+# A copy of this module lives in website/blog/, virtual_stations/ and
+# transparent_bridge/, since each is run on its own;
+# transparent_bridge/test_shared_modules.py fails when they differ.
+#
+# Nothing touches AWS or the credentials file until the first resource is
+# asked for. After that the process shares one session, and each thread
+# gets its own resource per (service, region), since boto3 sessions and
+# resources are not thread-safe; they are created under the lock. Each
+# resource's connection pool holds up to MAX_POOL_CONNECTIONS kept-alive
+# connections, and its calls are retried with adaptive (client-side rate
+# limited) backoff.
+
+import csv
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+CREDENTIALS_CSV = '../../Ana_accessKeys.csv'   # header line, then access key id and secret
+REGION = 'eu-north-1'
+MAX_POOL_CONNECTIONS = 50
+
+config = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=10,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+)
+
+lock = threading.RLock()
+shared_session = None
+local = threading.local()  # the calling thread's resources and tables
+
+
+def read_credentials(path=CREDENTIALS_CSV):
+    """Access key id and secret from the credentials CSV, or None when there
+    is no such file, leaving boto3 to its usual credential chain."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as csvfile:
+        csv_reader = csv.reader(csvfile)
+        next(csv_reader, None)
+        second_line = next(csv_reader, None)
+    if not second_line:
+        return None
+    return {'aws_access_key_id': second_line[0], 'aws_secret_access_key': second_line[1]}
+
+
+def session():
+    global shared_session
+    with lock:
+        if shared_session is None:
+            shared_session = boto3.session.Session(region_name=REGION, **(read_credentials() or {}))
+        return shared_session
+
+
+def resource(service='dynamodb', region=None):
+    resources = local.__dict__.setdefault('resources', {})
+    key = (service, region or REGION)
+    if key not in resources:
+        with lock:
+            resources[key] = session().resource(service, region_name=key[1], config=config)
+    return resources[key]
+
+
+def table(name, region=None):
+    tables = local.__dict__.setdefault('tables', {})
+    key = (name, region or REGION)
+    if key not in tables:
+        tables[key] = resource('dynamodb', region).Table(name)
+    return tables[key]
@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+
+
+class DynamoDBBatchWriter:
+    """Buffers items on a bounded queue and writes them from a background
+    thread with BatchWriteItem, flushing when a batch is full or its oldest
+    item is max_age seconds old.
+
+    `table` is a boto3 DynamoDB Table resource, or anything with a `name`
+    and a `meta.client.batch_write_item` accepting plain Python items.
+    `after_write`, if given, is called from the writer thread with the list
+    of items each batch actually stored. `overwrite_by_pkeys` names the
+    table's key attributes, so a batch keeps only the last item per key.
+
+    Throttling and server errors are retried with exponential backoff; any
+    other error (a malformed item, a missing table, bad credentials) would
+    fail again, so the batch is dropped right away.
+    """
+
+    MAX_BATCH = 25  # BatchWriteItem limit
+    RETRYABLE_ERRORS = {
+        'ProvisionedThroughputExceededException',
+        'ThrottlingException',
+        'RequestLimitExceeded',
+        'InternalServerError',
+        'ServiceUnavailable',
+    }
+
+    def __init__(self, table, batch_size=25, max_age=1.0, max_queue=10000,
+                 max_retries=8, overwrite_by_pkeys=None, after_write=None):
+        self.table_name = table.name
+        self.client = table.meta.client
+        self.batch_size = min(batch_size, self.MAX_BATCH)
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self.overwrite_by_pkeys = overwrite_by_pkeys
+        self.after_write = after_write
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="dynamodb-writer", daemon=True)
+        self.thread.start()
+
+    def store_item(self, item, timeout=0):
+        """Queue an item for writing. Returns False when the queue stays full
+        for `timeout` seconds (None waits for room), so the caller can
+        withhold its acknowledgement and let the sender retry later."""
+        try:
+            if timeout == 0:
+                self.queue.put_nowait(item)
+            else:
+                self.queue.put(item, timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def saturated(self):
+        return self.queue.full()
+
+    def flush(self):
+        """Block until every queued item has been written or given up on."""
+        self.queue.join()
+
+    def close(self, timeout=None):
+        """Write out what is queued and stop the writer thread."""
+        self.stopping.set()
+        self.thread.join(timeout)
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self.next_batch()
+            if batch:
+                try:
+                    written = self.write_batch(batch)
+                    if self.after_write and written:
+                        self.after_write(written)
+                except Exception as e:
+                    print(f"Error after writing batch to DynamoDB: {e}")
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+
+    def next_batch(self):
+        """Collect up to batch_size items, waiting at most max_age after the
+        first one arrives."""
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_age
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stopping.is_set():
+                remaining = 0
+            try:
+                if remaining:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @classmethod
+    def retryable(cls, error):
+        """Whether a failed request is worth retrying: throttling and 5xx
+        errors, judged from the response a botocore ClientError carries."""
+        response = getattr(error, 'response', None) or {}
+        code = response.get('Error', {}).get('Code')
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in cls.RETRYABLE_ERRORS or status >= 500
+
+    def write_batch(self, items):
+        """Write items, retrying unprocessed ones; returns the items stored."""
+        if self.overwrite_by_pkeys:
+            # BatchWriteItem rejects two puts with the same key in one request
+            latest = {tuple(item.get(key) for key in self.overwrite_by_pkeys): item for item in items}
+            items = list(latest.values())
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 5.0))
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            except Exception as e:
+                print(f"Error writing batch to DynamoDB: {e}")
+                if not self.retryable(e):
+                    break
+                continue
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not requests:
+                return items
+        print(f"Dropping {len(requests)} items after {attempt} retries")
+        dropped = [request['PutRequest']['Item'] for request in requests]
+        return [item for item in items if item not in dropped]
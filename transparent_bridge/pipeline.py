@@ -0,0 +1,62 @@
+import queue
+import threading
+
+BLOCK = "block"   # wait up to block_timeout for room, then reject the item
+DROP = "drop"     # reject the item at once when the queue is full
+
+_STOP = object()
+
+
+class Stage:
+    """One pipeline stage: a bounded queue drained by a pool of worker
+    threads calling `handler(item)`. When the queue is full, `offer` applies
+    the stage's policy and returns False if the item was not accepted, so a
+    slow stage only ever holds up the stages that feed it."""
+
+    def __init__(self, name, handler, workers=1, max_queue=1000, policy=BLOCK, block_timeout=None):
+        self.name = name
+        self.handler = handler
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.rejected = 0
+        self.rejected_lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.run, name=f"{name}-{i}", daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def offer(self, item):
+        try:
+            if self.policy == BLOCK:
+                self.queue.put(item, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            with self.rejected_lock:
+                self.rejected += 1
+                rejected = self.rejected
+            if rejected % 100 == 1:
+                print(f"Stage '{self.name}' is full, {rejected} items rejected so far")
+            return False
+        return True
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self.handler(item)
+            except Exception as e:
+                print(f"Error in stage '{self.name}': {e}")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """Process everything already queued, then stop the workers."""
+        self.queue.join()
+        for _ in self.workers:
+            self.queue.put(_STOP)
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,96 @@
+import unittest
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+
+from dynamodb_writer import DynamoDBBatchWriter
+
+
+def client_error(code, status):
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, 'BatchWriteItem')
+
+
+class FakeClient:
+    """In-memory stand-in for DynamoDB's BatchWriteItem: raises the queued
+    `errors` first, leaves the first `unprocessed` items of a request
+    unprocessed once, and rejects a request with two puts to one key as
+    DynamoDB does."""
+
+    def __init__(self, key, errors=(), unprocessed=0):
+        self.key = key
+        self.errors = list(errors)
+        self.unprocessed = unprocessed
+        self.items = {}
+        self.calls = 0
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        (table_name, requests), = RequestItems.items()
+        keys = [request['PutRequest']['Item'][self.key] for request in requests]
+        if len(set(keys)) != len(keys):
+            raise client_error('ValidationException', 400)
+        left, self.unprocessed = requests[:self.unprocessed], 0
+        for request in requests[len(left):]:
+            item = request['PutRequest']['Item']
+            self.items[item[self.key]] = item
+        return {'UnprocessedItems': {table_name: left} if left else {}}
+
+
+class DynamoDBBatchWriterTest(unittest.TestCase):
+
+    def write(self, client, items, **kwargs):
+        table = SimpleNamespace(name='DHT11', meta=SimpleNamespace(client=client))
+        written = []
+        writer = DynamoDBBatchWriter(table, max_age=0.05, max_retries=3, after_write=written.extend, **kwargs)
+        for item in items:
+            self.assertTrue(writer.store_item(item))
+        writer.close()
+        return written
+
+    def reading(self, second, temperature=21):
+        return {'time_stamp': f"2024-05-01 10:42:{second:02d}", 'temperature': temperature}
+
+    def test_writes_in_batches(self):
+        client = FakeClient('time_stamp')
+        items = [self.reading(second) for second in range(30)]
+        self.assertEqual(sorted(self.write(client, items), key=lambda item: item['time_stamp']), items)
+        self.assertEqual(len(client.items), 30)
+        self.assertEqual(client.calls, 2)
+
+    def test_keeps_the_last_duplicate(self):
+        client = FakeClient('time_stamp')
+        items = [self.reading(1), self.reading(2), self.reading(1, temperature=22)]
+        self.write(client, items, overwrite_by_pkeys=['time_stamp'])
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(client.items['2024-05-01 10:42:01']['temperature'], 22)
+        self.assertEqual(len(client.items), 2)
+
+    def test_retries_throttling_and_server_errors(self):
+        client = FakeClient('time_stamp', errors=[client_error('ProvisionedThroughputExceededException', 400),
+                                                  client_error('InternalServerError', 500)])
+        self.assertEqual(len(self.write(client, [self.reading(1)])), 1)
+        self.assertEqual(client.calls, 3)
+        self.assertEqual(len(client.items), 1)
+
+    def test_retries_unprocessed_items(self):
+        client = FakeClient('time_stamp', unprocessed=2)
+        self.assertEqual(len(self.write(client, [self.reading(second) for second in range(5)])), 5)
+        self.assertEqual(client.calls, 2)
+        self.assertEqual(len(client.items), 5)
+
+    def test_drops_a_batch_that_cannot_succeed(self):
+        client = FakeClient('time_stamp', errors=[client_error('ValidationException', 400)])
+        self.assertEqual(self.write(client, [self.reading(1)]), [])
+        self.assertEqual(client.calls, 1)
+
+    def test_gives_up_after_max_retries(self):
+        client = FakeClient('time_stamp', errors=[client_error('ThrottlingException', 400)] * 10)
+        self.assertEqual(self.write(client, [self.reading(1)]), [])
+        self.assertEqual(client.calls, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
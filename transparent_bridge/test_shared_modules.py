@@ -0,0 +1,26 @@
+import os
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules copied into every folder that is deployed or run on its own
+COPIES = {
+    'aws_clients.py': ['transparent_bridge', 'website/blog', 'virtual_stations'],
+    'rollups.py': ['transparent_bridge', 'LambdaFunction'],
+}
+
+
+class SharedModulesTest(unittest.TestCase):
+
+    def test_copies_match(self):
+        for name, folders in COPIES.items():
+            with open(os.path.join(ROOT, folders[0], name), 'rb') as f:
+                original = f.read()
+            for folder in folders[1:]:
+                with self.subTest(module=name, folder=folder):
+                    with open(os.path.join(ROOT, folder, name), 'rb') as f:
+                        self.assertEqual(f.read(), original, f"{folder}/{name} differs from {folders[0]}/{name}")
+
+
+if __name__ == '__main__':
+    unittest.main()
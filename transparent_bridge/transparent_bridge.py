@@ -1,12 +1,24 @@
 import MQTTSNclient
 from MQTTSNclient import Client
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+from dynamodb_writer import DynamoDBBatchWriter
+from pipeline import Stage, BLOCK, DROP
+from rollups import update_rollups
+from decimal import Decimal
+from datetime import datetime, timezone
+import struct
+import threading
 import logging
+import signal
 import json
-import boto3
+import aws_clients
 
 DYNAMO_TABLE = ""
 DYNAMO_REGION = ""
+DYNAMO_BATCH_SIZE = 25      # items per BatchWriteItem call (at most 25)
+DYNAMO_MAX_AGE = 1.0        # seconds an item may wait for its batch to fill
+DYNAMO_QUEUE_SIZE = 10000   # items buffered before new messages are refused
+DYNAMO_ROLLUP_TABLE = ""    # minute/hour rollups per station; empty disables them
 
 MQTT_CLIENT_ID  = ""
 MQTT_TOPIC = ""
@@ -20,19 +32,59 @@ AWS_PORT = 8883
 MQTTSN_CLIENT_ID = ""
 MQTTSN_PORT = 1885
 
+# Sensors publishing the compact binary format (PAYLOAD_FORMAT = "binary" in
+# PicoW/PicoW_dht11_Mqtt.py) use MQTT_TOPIC + BINARY_TOPIC_SUFFIX; those
+# payloads are forwarded as they are on the same suffixed AWS IoT topic
+BINARY_TOPIC_SUFFIX = "/bin"
+BINARY_VERSION = 1
+BINARY_RECORD = struct.Struct('<IHbB')  # epoch seconds, milliseconds, temperature, humidity
+
+# Messages flow receive -> decode -> (AWS IoT, DynamoDB) through bounded
+# queues, each sink with its own workers. When a sink's queue is full, DROP
+# discards the message for that sink only; BLOCK waits, which eventually
+# backs up decoding and leaves new MQTT-SN messages unacknowledged. Messages
+# are acknowledged once decoding accepts them, so the DynamoDB sink waits
+# without a timeout: rejecting an item there would lose an acknowledged
+# reading.
+DECODE_WORKERS = 2
+DECODE_QUEUE_SIZE = 1000
+RECEIVE_BLOCK_TIMEOUT = 0.05  # seconds the receiver waits for room in the decode queue
+AWS_FORWARD_WORKERS = 4     # threads publishing to AWS IoT
+AWS_QUEUE_SIZE = 1000
+AWS_QUEUE_POLICY = DROP
+AWS_BLOCK_TIMEOUT = 1.0
+DYNAMO_WORKERS = 1
+DYNAMO_QUEUE_POLICY = BLOCK
+DYNAMO_BLOCK_TIMEOUT = None
+SUPERVISOR_INTERVAL = 5.0   # seconds between receiver health checks
+SHUTDOWN_TIMEOUT = 10.0     # seconds to wait for in-flight messages on exit
+
 class DynamoDBConnector:
-    def __init__(self, region, table):
+    def __init__(self, region, table_name, rollup_table_name=""):
         self.region = region
-        self.table = table
-        self.dynamo_resource = boto3.resource('dynamodb', region_name=self.region)
-        self.table = self.dynamo_resource.Table(self.table_name)
+        self.table_name = table_name
+        self.table = aws_clients.table(self.table_name, self.region)
+        self.rollup_table = aws_clients.table(rollup_table_name, self.region) if rollup_table_name else None
+        # a QoS 1 redelivery can put the same reading in a batch twice, which
+        # BatchWriteItem rejects as a whole, so keep the last item per key
+        primary_keys = [key['AttributeName'] for key in self.table.key_schema]
+        self.writer = DynamoDBBatchWriter(self.table, batch_size=DYNAMO_BATCH_SIZE,
+                                          max_age=DYNAMO_MAX_AGE, max_queue=DYNAMO_QUEUE_SIZE,
+                                          overwrite_by_pkeys=primary_keys,
+                                          after_write=self.store_rollups if self.rollup_table else None)
 
-    def store_item(self, item):
-        try:
-            self.table.put_item(Item=item)
-            print(f"Item stored in DynamoDB: {item}")
-        except Exception as e:
-            print(f"Error storing item in DynamoDB: {e}")
+    def store_item(self, item, timeout=0):
+        """Queue the item for a batched write; False means the write queue
+        stayed full for `timeout` seconds."""
+        return self.writer.store_item(item, timeout)
+
+    def store_rollups(self, items):
+        # Runs on the writer thread once a batch is stored; only the sensor
+        # readings, as the Lambda does, not every numeric attribute
+        update_rollups(self.rollup_table, items, metrics=['temperature', 'humidity'])
+
+    def close(self):
+        self.writer.close()
 
 class MQTTClientHandler:
     def __init__(self, client_id, host, port, root_ca, cert, key):
@@ -61,48 +113,180 @@ class MQTTClientHandler:
         self.client.publish(topic, payload, qos)
 
 class MQTTSNClientHandler:
-    def __init__(self, client_id, port):
+    def __init__(self, client_id, port, handler):
         self.client_id = client_id
         self.port = port
+        self.handler = handler
+        self.topics = []
         self.client = MQTTSNclient.Client(self.client_id, port=self.port)
         self.configure_client()
     
     def configure_client(self):
-        self.client.registerCallback(MessageHandler())
+        self.client.registerCallback(self.handler)
         self.client.connect()
     
     def subscribe(self, topic):
-        self.client.subscribe(topic)
+        self.topics.append(topic)
+        self.register_topic(topic, self.client.subscribe(topic))
+
+    def register_topic(self, topic, subscription):
+        # messages on normal topics arrive with the topic id instead of its name
+        rc, topic_id = subscription
+        if rc != 0:
+            raise Exception(f"Subscription to '{topic}' refused with return code {rc}")
+        self.handler.topic_names[topic_id] = topic
+
+    def alive(self):
+        return self.client.receiverAlive()
+
+    def reconnect(self):
+        # connect() starts a new receiver, but the bridge is only back once
+        # every topic is subscribed again; otherwise stop the receiver so
+        # alive() stays False and the supervisor retries on its next check
+        self.client.connect()
+        try:
+            for topic in self.topics:
+                self.register_topic(topic, self.client.subscribe(topic))
+        except Exception:
+            self.client.stopReceiver()
+            raise
+
+    def drain(self, timeout):
+        return self.client.drain(timeout)
     
     def disconnect(self):
-        self.client.disconnect()
+        try:
+            self.client.disconnect()
+        finally:
+            self.client.stopReceiver()
+
+def decode_binary(payload, topic):
+    """Readings of a binary payload: a version byte, then one
+    BINARY_RECORD per reading."""
+    if payload[:1] != bytes([BINARY_VERSION]) or (len(payload) - 1) % BINARY_RECORD.size:
+        raise ValueError(f"Not a version {BINARY_VERSION} binary payload")
+    items = []
+    for seconds, milliseconds, temperature, humidity in BINARY_RECORD.iter_unpack(payload[1:]):
+        time_stamp = datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        items.append({
+            'time_stamp': f"{time_stamp}.{milliseconds * 1000000:09d}",
+            'timestamp_ms': seconds * 1000 + milliseconds,
+            'temperature': temperature,
+            'humidity': humidity,
+            'topic': topic,
+        })
+    return items
 
 class MessageHandler:
+    def __init__(self, mqtt_client, dynamo_connector):
+        self.mqtt_client = mqtt_client
+        self.dynamo_connector = dynamo_connector
+        self.topic_names = {}
+        self.decoder = Stage("decode", self.decode, workers=DECODE_WORKERS, max_queue=DECODE_QUEUE_SIZE,
+                             policy=BLOCK, block_timeout=RECEIVE_BLOCK_TIMEOUT)
+        self.aws_sink = Stage("aws-iot", self.forward, workers=AWS_FORWARD_WORKERS, max_queue=AWS_QUEUE_SIZE,
+                              policy=AWS_QUEUE_POLICY, block_timeout=AWS_BLOCK_TIMEOUT)
+        self.dynamo_sink = Stage("dynamodb", self.store, workers=DYNAMO_WORKERS, max_queue=DYNAMO_QUEUE_SIZE,
+                                 policy=DYNAMO_QUEUE_POLICY, block_timeout=DYNAMO_BLOCK_TIMEOUT)
+
     def on_message(self, topic_name, payload, qos, retained, msgid):
-        payload_json = json.loads(payload)
+        # runs on the MQTT-SN receiver thread, so only hand the message on;
+        # if the pipeline is full, leave QoS 1/2 messages unacknowledged so
+        # the sender retries later
+        return self.decoder.offer((topic_name, payload, qos))
+
+    # the MQTT-SN receiver delivers messages through messageArrived
+    messageArrived = on_message
+
+    def decode(self, message):
+        topic_name, payload, qos = message
+        topic_name = self.topic_names.get(topic_name, topic_name)
         print(f"Message received on topic '{topic_name}': {payload}")
-        mqtt_client.publish(MQTT_TOPIC, payload, qos)
-        dynamo_connector.store_item(payload_json)
-        return True
+        if str(topic_name).endswith(BINARY_TOPIC_SUFFIX):
+            items = decode_binary(payload, MQTT_TOPIC)
+            self.aws_sink.offer((MQTT_TOPIC + BINARY_TOPIC_SUFFIX, payload, qos))
+        else:
+            items = json.loads(payload, parse_float=Decimal)
+            if not isinstance(items, list):
+                # a single reading rather than a batch
+                items = [items]
+            self.aws_sink.offer((MQTT_TOPIC, payload, qos))
+        for item in items:
+            self.dynamo_sink.offer(item)
 
-def setup_logging():
-    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    logging.basicConfig(level=logging.NOTSET, format=log_format)
+    def forward(self, message):
+        topic, payload, qos = message
+        # AWS IoT only supports QoS 0 and 1
+        self.mqtt_client.publish(topic, payload, min(max(qos, 0), 1))
+
+    def store(self, item):
+        # the writer batches on its own thread; waiting here for room in its
+        # queue holds items back in this stage instead of dropping them
+        self.dynamo_connector.store_item(item, timeout=None)
+
+    def close(self):
+        self.decoder.close()
+        self.aws_sink.close()
+        self.dynamo_sink.close()
+
+class BridgeSupervisor:
+    """Owns the bridge's workers: the MQTT-SN receiver thread, the message
+    pipeline stages and the DynamoDB writer. The main thread blocks
+    until SIGINT/SIGTERM, restarting the receiver if it dies, and then
+    drains every stage before disconnecting."""
+
+    def __init__(self):
+        self.shutdown = threading.Event()
 
-setup_logging()
-mqtt_client = MQTTClientHandler(MQTT_CLIENT_ID, AWS_HOST, AWS_PORT, AWS_ROOT_CA, AWS_CERT, AWS_PRIVATE_KEY)
-mqtt_client.connect()
+    def start(self):
+        self.mqtt_client = MQTTClientHandler(MQTT_CLIENT_ID, AWS_HOST, AWS_PORT, AWS_ROOT_CA, AWS_CERT, AWS_PRIVATE_KEY)
+        self.mqtt_client.connect()
 
-dynamo_connector = DynamoDBConnector(region=DYNAMO_REGION, table_name=DYNAMO_TABLE)
+        self.dynamo_connector = DynamoDBConnector(region=DYNAMO_REGION, table_name=DYNAMO_TABLE,
+                                                  rollup_table_name=DYNAMO_ROLLUP_TABLE)
 
-mqtt_sn_client = MQTTSNClientHandler(client_id=MQTTSN_CLIENT_ID, port=MQTTSN_PORT)
-mqtt_sn_client.subscribe(MQTT_TOPIC)
+        self.handler = MessageHandler(self.mqtt_client, self.dynamo_connector)
+        self.mqtt_sn_client = MQTTSNClientHandler(client_id=MQTTSN_CLIENT_ID, port=MQTTSN_PORT, handler=self.handler)
+        self.mqtt_sn_client.subscribe(MQTT_TOPIC)
+        self.mqtt_sn_client.subscribe(MQTT_TOPIC + BINARY_TOPIC_SUFFIX)
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self.shutdown.set())
+        while not self.shutdown.wait(SUPERVISOR_INTERVAL):
+            if not self.mqtt_sn_client.alive():
+                print("MQTT-SN receiver stopped, reconnecting...")
+                try:
+                    self.mqtt_sn_client.reconnect()
+                except Exception as e:
+                    print(f"Error reconnecting to the MQTT-SN gateway: {e}")
+
+    def stop(self):
+        print("Terminating the connection...")
+        try:
+            if not self.mqtt_sn_client.drain(SHUTDOWN_TIMEOUT):
+                print("Timed out waiting for in-flight MQTT-SN messages")
+            self.mqtt_sn_client.disconnect()
+        except Exception as e:
+            # the gateway may be gone; what was received must still be stored
+            print(f"Error disconnecting from the MQTT-SN gateway: {e}")
+        finally:
+            self.handler.close()
+            self.dynamo_connector.close()
+            self.mqtt_client.client.disconnect()
+
+def setup_logging():
+    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.NOTSET, format=log_format)
 
-try:
-    while True:
-        pass
-except KeyboardInterrupt:
-    print("Terminating the connection...")
+def main():
+    setup_logging()
+    supervisor = BridgeSupervisor()
+    supervisor.start()
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop()
 
-mqtt_sn_client.disconnect()
-mqtt_client.client.disconnect()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -7,40 +7,35 @@ import time
 import json
 import datetime
 import argparse
-import boto3
 import parser
-
-import csv
-
-csv_file_path = '../../Ana_accessKeys.csv'
-
-with open(csv_file_path, 'r') as csvfile:
-    csv_reader = csv.reader(csvfile)
-
-    # Skip the first line (header)
-    header = next(csv_reader, None)
-
-    # Read the second line
-    second_line = next(csv_reader, None)
-
-    if second_line:
-        aws_access_key_id = second_line[0]
-        aws_secret_access_key = second_line[1]
-
-boto3.setup_default_session(
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name='eu-north-1'  # Replace with your actual AWS region
-)
-
-dynamodb = boto3.resource('dynamodb', region_name='eu-north-1')                    # connection to DynamoDB and access
-dynamoTable = dynamodb.Table('EnvironmentalStationData')                                     # to the table EnvironmentalStation that will store the data provided
-jsonP = '';                                                                         # by the two simulated stations
+import os
+import urllib.request
+
+import aws_clients                                                                  # shared AWS session, created when first used
+
+dataTable = 'EnvironmentalStationData'                                              # DynamoDB table (on the region set in aws_clients.py)
+jsonP = '';                                                                         # that will store the data provided by the two simulated stations
+registryTable = 'EnvironmentalStations'                                             # one item per station, read by the website to list the stations
+registered = set()                                                                  # stations already added to the registry by this process
+websiteUrl = os.environ.get('BLOG_URL', 'http://127.0.0.1:8000')                    # website told about every stored reading, so it refreshes its cache and live feed
+ingestToken = os.environ.get('BLOG_INGEST_TOKEN', '')                               # must match INGEST_TOKEN in the website settings
+
+def notify_website(reading):                                                        # the function reports a stored reading to the website; the data are already safe in DynamoDB, so a failure is only printed
+    request = urllib.request.Request(websiteUrl + '/api/ingested/', data=json.dumps(reading).encode(),
+                                     headers={'Content-Type': 'application/json', 'X-Ingest-Token': ingestToken})
+    try:
+        urllib.request.urlopen(request, timeout=2).close()
+    except OSError as e:
+        print("Could not notify the website: %s" % e)
 
 def data_store(client, userdata, msg):                                              # the function stores the recieved data in the DynamoDB table
     payload = str(msg.payload)[2:-1]
     jsonP = json.loads(payload)
-    dynamoTable.put_item(Item=jsonP)
+    aws_clients.table(dataTable).put_item(Item=jsonP)
+    if jsonP['ID'] not in registered:
+        aws_clients.table(registryTable).put_item(Item={'ID': jsonP['ID']})
+        registered.add(jsonP['ID'])
+    notify_website(jsonP)
 
 
 def send_data(myClient, data, topic):                                               # the function publishes the recieved data
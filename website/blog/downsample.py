@@ -0,0 +1,92 @@
+import numpy as np
+
+# Columnar downsampling of station readings.
+#
+# Readings are columns (one list or array per attribute, as built by
+# views.columns) with a 'timestamp' column of 'YYYY-MM-DD HH:MM:SS' strings
+# or of integer epoch seconds, which skips parsing. They are bucketed on
+# epoch seconds, `width` seconds per bucket, and each bucket is reduced with
+# one of AGGREGATES, all with NumPy array operations.
+
+AGGREGATES = ('first', 'last', 'mean', 'min', 'max')
+
+# Timestamp strings (or epoch seconds already) as an int64 array of epoch seconds
+
+def epoch_seconds(timestamps):
+    array = np.asarray(timestamps)
+    if np.issubdtype(array.dtype, np.integer):
+        return array.astype(np.int64)
+    return array.astype('datetime64[s]').astype(np.int64)
+
+def format_epoch(seconds):
+    strings = np.datetime_as_string(np.asarray(seconds, dtype='datetime64[s]'), unit='s')
+    return np.char.replace(strings, 'T', ' ').astype(object)
+
+# Start index of every bucket in a sorted epoch array, and the bucket starts
+
+def buckets(epoch, width: int):
+    keys = epoch // width
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return starts, keys[starts] * width
+
+def numeric(values):
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+
+# NaN (a bucket without any value) as None, which serialises as JSON null
+
+def nan_to_none(array):
+    values = array.astype(object)
+    values[np.isnan(array)] = None
+    return values.tolist()
+
+# Reduce the readings in data to one per `width` second bucket, keeping only
+# the most recent `limit` buckets if given. 'first' and 'last' return actual
+# readings; 'mean', 'min' and 'max' return the bucket start as the timestamp,
+# the aggregate of every numeric column and the first value of the others.
+# Missing values (None) are left out of the aggregates, and a bucket with
+# none at all gets None
+
+def downsample(data: dict, width: int = 60, how: str = 'first', limit: int = None):
+    if how not in AGGREGATES:
+        raise ValueError(f'unknown aggregate {how!r}, expected one of {AGGREGATES}')
+    epoch = epoch_seconds(data['timestamp'])
+    if len(epoch) == 0:
+        return {name: [] for name in data}
+    order = np.argsort(epoch, kind='stable')
+    epoch = epoch[order]
+    starts, bucket_starts = buckets(epoch, width)
+    if limit is not None and len(starts) > limit:
+        first_row = starts[-limit]
+        epoch, order = epoch[first_row:], order[first_row:]
+        starts, bucket_starts = starts[-limit:] - first_row, bucket_starts[-limit:]
+    ends = np.concatenate((starts[1:], [len(epoch)]))
+
+    if how in ('first', 'last'):
+        rows = order[starts if how == 'first' else ends - 1]
+        return {name: np.asarray(values)[rows].tolist() for name, values in data.items()}
+
+    result = {}
+    for name, values in data.items():
+        if name == 'timestamp':
+            text = not np.issubdtype(np.asarray(values).dtype, np.integer)
+            result[name] = (format_epoch(bucket_starts) if text else bucket_starts).tolist()
+            continue
+        array = numeric(values)
+        if array is None:
+            result[name] = np.asarray(values, dtype=object)[order[starts]].tolist()
+            continue
+        array = array[order]
+        if how == 'mean':
+            present = ~np.isnan(array)
+            sums = np.add.reduceat(np.where(present, array, 0.0), starts)
+            counts = np.add.reduceat(present.astype(np.int64), starts)
+            with np.errstate(invalid='ignore'):
+                result[name] = nan_to_none(sums / counts)
+        elif how == 'min':
+            result[name] = nan_to_none(np.fmin.reduceat(array, starts))
+        else:
+            result[name] = nan_to_none(np.fmax.reduceat(array, starts))
+    return result
@@ -0,0 +1,149 @@
+import asyncio
+import hmac
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import views
+
+# Live readings for the dashboard, pushed to browsers as server-sent events
+# by the ASGI app `live` (routed at /live/ in django_web/asgi.py).
+#
+# Every connected browser gets its own small queue, but all of them are fed
+# by one upstream: a single thread that polls the cached station tails while
+# anyone is listening, plus publish_reading() for every reading ingestion
+# reports to /api/ingested/. N viewers cost one feed instead of N query loops.
+
+LIVE_POLL_INTERVAL = views.CACHE_TTL   # seconds between polls of the station tails
+LIVE_QUEUE_SIZE = 100                  # readings buffered per browser; the oldest are dropped
+LIVE_KEEPALIVE = 15                    # seconds between comments keeping idle connections open
+
+
+class Broadcaster:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()       # (event loop, queue) of every connected browser
+        self.last_sent = {}            # station -> timestamp of the newest reading sent
+        self.poller = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add((asyncio.get_running_loop(), queue))
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll, name='live-poller', daemon=True)
+                self.poller.start()
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers = {(loop, q) for loop, q in self.subscribers if q is not queue}
+
+    def publish(self, station_str: str, readings: list):
+        # Send the readings newer than the last one sent for the station;
+        # safe to call from any thread
+        with self.lock:
+            last = self.last_sent.get(station_str, '')
+            readings = [reading for reading in readings if reading['timestamp'] > last]
+            if not readings:
+                return
+            self.last_sent[station_str] = readings[-1]['timestamp']
+            subscribers = list(self.subscribers)
+        for reading in readings:
+            data = json.dumps(reading, cls=DjangoJSONEncoder)
+            for loop, queue in subscribers:
+                loop.call_soon_threadsafe(offer, queue, data)
+
+    def poll(self):
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.poller = None
+                    self.last_sent.clear()
+                    return
+            try:
+                stations = views.discover_stations()
+                for station_str, tail in zip(stations, views.loader_pool.map(views.station_tail, stations)):
+                    if station_str not in self.last_sent and tail:
+                        # Start from the newest reading rather than replaying the last hour
+                        self.last_sent[station_str] = tail[-1]['timestamp']
+                    self.publish(station_str, views.newer_than(tail, self.last_sent.get(station_str, '')))
+            except Exception as e:
+                print(f"Error polling live readings: {e}")
+            time.sleep(LIVE_POLL_INTERVAL)
+
+
+def offer(queue, data):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(data)
+
+
+broadcaster = Broadcaster()
+
+# Push a stored reading to the browsers at once and refresh the cached
+# windows of its station
+
+def publish_reading(reading: dict):
+    views.invalidate_station(reading['ID'])
+    broadcaster.publish(reading['ID'], [reading])
+
+# Ingestion endpoint: POST /api/ingested/ with a stored reading as the JSON
+# body ({"ID": ..., "timestamp": ..., ...}), sent by the station simulator
+# after every write to DynamoDB. When settings.INGEST_TOKEN is set the
+# request must carry it in the X-Ingest-Token header
+
+@csrf_exempt
+@require_POST
+def ingested(request):
+    if settings.INGEST_TOKEN and not hmac.compare_digest(request.headers.get('X-Ingest-Token', ''), settings.INGEST_TOKEN):
+        return HttpResponseForbidden('wrong ingest token')
+    try:
+        reading = json.loads(request.body)
+    except ValueError:
+        reading = None
+    if not isinstance(reading, dict) or not isinstance(reading.get('ID'), str) or not isinstance(reading.get('timestamp'), str):
+        return HttpResponseBadRequest('expected a JSON reading with ID and timestamp')
+    publish_reading(reading)
+    return HttpResponse(status=204)
+
+
+async def live(scope, receive, send):
+    stations = set(parse_qs(scope['query_string'].decode()).get('station', []))
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')],
+    })
+    queue = broadcaster.subscribe()
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        while not disconnected.done():
+            get = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait([get, disconnected], timeout=LIVE_KEEPALIVE,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if get not in done:
+                get.cancel()
+                message = b': keepalive\n\n'
+            elif stations and json.loads(get.result())['ID'] not in stations:
+                continue
+            else:
+                message = f'event: reading\ndata: {get.result()}\n\n'.encode()
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+    finally:
+        broadcaster.unsubscribe(queue)
+        disconnected.cancel()
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
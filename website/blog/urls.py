@@ -1,8 +1,11 @@
 from django.urls import path
-from . import views
+from . import views, live
 
 urlpatterns = [
     path('', views.home, name='blog-home'),
     path('storage/', views.storage, name='blog-storage'),
     path('chart/', views.charts, name='blog-chart'),
+    path('api/since/', views.since, name='blog-since'),
+    path('api/series/', views.series, name='blog-series'),
+    path('api/ingested/', live.ingested, name='blog-ingested'),
 ]
@@ -1,202 +1,361 @@
 from django.shortcuts import render
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponseBadRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.cache import cache
 from subprocess import run, PIPE
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-import csv
-
-csv_file_path = '../../Ana_accessKeys.csv'
-
-with open(csv_file_path, 'r') as csvfile:
-    csv_reader = csv.reader(csvfile)
-
-    # Skip the first line (header)
-    header = next(csv_reader, None)
-
-    # Read the second line
-    second_line = next(csv_reader, None)
-
-    if second_line:
-        aws_access_key_id = second_line[0]
-        aws_secret_access_key = second_line[1]
-
-boto3.setup_default_session(
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name='eu-north-1'  # Replace with your actual AWS region
-)
-
-last_hour_r = datetime.now() - timedelta(hours = 1)
+from . import aws_clients
+from .downsample import downsample, epoch_seconds, numeric, nan_to_none, AGGREGATES
 
 batch_size = 500
 
-# Change the region name and the table name
-client = boto3.client('dynamodb');
-dynamoDB = boto3.resource('dynamodb', region_name='eu-north-1')     # connection to DynamoDB and access
-dynamoTable = dynamoDB.Table('EnvironmentalStationData')               # to the table EnvironmentalStation that will store the data provided
+# Change the table names here and the region name in aws_clients.py.
+# The tables are resolved on first use, through the shared connection pool
+DATA_TABLE = 'EnvironmentalStationData'      # readings of every station, partition key ID and sort key timestamp
+REGISTRY_TABLE = 'EnvironmentalStations'     # one item (partition key ID) per station, added by the simulator
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Attributes of a station reading shown by the views
+STATION_ATTRIBUTES = ['ID', 'timestamp', 'Temperature', 'WindIntensity', 'WindDirection', 'Humidity', 'RainHeight']
+
+def projection(attributes):
+    # 'timestamp' is a DynamoDB reserved word, so every name goes through a placeholder
+    names = {f'#a{i}': name for i, name in enumerate(attributes)}
+    return {'ProjectionExpression': ', '.join(names), 'ExpressionAttributeNames': names}
+
+def query_pages(key_condition, attributes=None, newest_first=False, limit=None):
+
+    # Follow LastEvaluatedKey so results are not cut at the 1 MB page size
+    kwargs = {'KeyConditionExpression': key_condition, 'ScanIndexForward': not newest_first}
+    if attributes:
+        kwargs.update(projection(attributes))
+
+    count = 0
+    while True:
+        if limit:
+            kwargs['Limit'] = limit - count
+        response = aws_clients.table(DATA_TABLE).query(**kwargs)
+        count += len(response['Items'])
+        yield response['Items']
+        if 'LastEvaluatedKey' not in response or (limit and count >= limit):
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def query_items(key_condition, attributes=None, newest_first=False, limit=None):
+    return [item for page in query_pages(key_condition, attributes, newest_first, limit) for item in page]
+
+# Most recent reading of a station, or None if it has none
+
+def latest_reading(station_str: str, attributes=STATION_ATTRIBUTES):
+    items = query_items(Key('ID').eq(station_str), attributes, newest_first=True, limit=1)
+    return items[0] if items else None
+
+# Readings of a station from start (a datetime) up to end, or up to now if end is None.
+# The window goes into the key condition, so only those readings are read
+
+def readings_between(station_str: str, start, end=None, attributes=STATION_ATTRIBUTES, newest_first=False):
+    key_condition = Key('ID').eq(station_str)
+    if end is None:
+        key_condition = key_condition & Key('timestamp').gte(start.strftime(TIMESTAMP_FORMAT))
+    else:
+        key_condition = key_condition & Key('timestamp').between(start.strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT))
+    return query_items(key_condition, attributes, newest_first)
+
+# Read-through cache for the queries above, keyed by station and window.
+# A result is fresh for CACHE_TTL seconds, or until the station is
+# invalidated, and then kept for up to CACHE_STALE_TTL seconds, during which
+# one request refreshes it while the others keep getting the stale value
+# instead of querying DynamoDB too. Windows with an `update` function are
+# refreshed from their stale value rather than loaded again.
+
+CACHE_TTL = 5
+CACHE_STALE_TTL = 60
+CACHE_LOCK_TIMEOUT = 10
+
+def version_key(station_str: str):
+    return f'blog:{station_str}:version'
+
+def read_through(station_str: str, window: str, load, update=None, keep=CACHE_STALE_TTL):
+    key = f'blog:{station_str}:{window}'
+    version = cache.get_or_set(version_key(station_str), time.time_ns(), None)
+    entry = cache.get(key)
+    if entry is not None and entry[0] > time.time() and entry[1] == version:
+        return entry[2]
+
+    # Only the request that takes the lock refreshes the value
+    if cache.add(key + ':lock', 1, CACHE_LOCK_TIMEOUT):
+        try:
+            value = update(entry[2]) if update and entry is not None else load()
+            cache.set(key, (time.time() + CACHE_TTL, version, value), keep)
+            return value
+        finally:
+            cache.delete(key + ':lock')
+    if entry is not None:
+        return entry[2]
+
+    # Nothing cached yet: wait for the request that is loading it
+    deadline = time.time() + CACHE_LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[2]
+    return load()
+
+# Hook for ingestion: mark every cached window of a station stale once new
+# readings are stored, by bumping the station's version
+
+def invalidate_station(station_str: str):
+    try:
+        cache.incr(version_key(station_str))
+    except ValueError:
+        cache.set(version_key(station_str), time.time_ns(), None)
+
+# The last TAIL_WINDOW of each station's readings, oldest first. Once loaded
+# it is only extended with the readings newer than its last one and trimmed
+# at the front, so a refresh reads just the new points
+
+TAIL_WINDOW = timedelta(hours = 1)
+TAIL_KEEP = 3600
+
+def load_tail(station_str: str):
+    return readings_between(station_str, datetime.now() - TAIL_WINDOW)
+
+def extend_tail(station_str: str, tail: list):
+    if not tail:
+        return load_tail(station_str)
+    newer = query_items(Key('ID').eq(station_str) & Key('timestamp').gt(tail[-1]['timestamp']), STATION_ATTRIBUTES)
+    start = (datetime.now() - TAIL_WINDOW).strftime(TIMESTAMP_FORMAT)
+    return newer_than(tail, start, inclusive=True) + newer
+
+def station_tail(station_str: str):
+    return read_through(station_str, 'tail', lambda: load_tail(station_str),
+                        lambda tail: extend_tail(station_str, tail), TAIL_KEEP)
+
+# Readings of a (timestamp ordered) tail after the given timestamp
+
+def newer_than(tail: list, timestamp: str, inclusive=False):
+    low, high = 0, len(tail)
+    while low < high:
+        middle = (low + high) // 2
+        if tail[middle]['timestamp'] < timestamp or (not inclusive and tail[middle]['timestamp'] == timestamp):
+            low = middle + 1
+        else:
+            high = middle
+    return tail[low:]
+
+def cached_latest_reading(station_str: str):
+    return read_through(station_str, 'latest', lambda: latest_reading(station_str))
 
 def home(request):
 
-    # Last data from station1
-    response = dynamoTable.query(
-        KeyConditionExpression = Key('ID').eq('station1')
-    )
-    items = response['Items']
-
-    context = {}
-    context['ID'] = (items[len(items) - 1]["ID"])
-    context['Temperature'] = (items[len(items) - 1]["Temperature"])
-    context['datetime'] = (items[len(items) - 1]["timestamp"])
-    context['WindIntensity'] = (items[len(items) - 1]["WindIntensity"])
-    context['WindDirection'] = (items[len(items) - 1]["WindDirection"])
-    context['Humidity'] = (items[len(items) - 1]["Humidity"])
-    context['RainHeight'] = (items[len(items) - 1]["RainHeight"])
-
-    # Last data from station2
-    response = dynamoTable.query(
-        KeyConditionExpression = Key('ID').eq('station2')
-    )
-    items = response['Items']
-
-    context['ID2'] = (items[len(items) - 1]["ID"])
-    context['Temperature2'] = (items[len(items) - 1]["Temperature"])
-    context['datetime2'] = (items[len(items) - 1]["timestamp"])
-    context['WindIntensity2'] = (items[len(items) - 1]["WindIntensity"])
-    context['WindDirection2'] = (items[len(items) - 1]["WindDirection"])
-    context['Humidity2'] = (items[len(items) - 1]["Humidity"])
-    context['RainHeight2'] = (items[len(items) - 1]["RainHeight"])
+    # Last data from every station
+    stations = discover_stations()
+    items = loader_pool.map(cached_latest_reading, stations)
 
+    context = {'stations': [item for item in items if item is not None]}
 
     return render(request, 'blog/home.html', context)
 
 
-def format_data(filtered_data, parameter_name:str, parameter_symbol:str):
-    
-    formatted_data = [f"{data[i]['timestamp']} | {data[i]['ID']} | {data[i][parameter_name]}{parameter_symbol}" for data in filtered_data for i in reversed(range(len(data)))]
+def format_data(stations: dict, parameter_name:str, parameter_symbol:str):
 
-    return reversed(formatted_data)
-
-def filter_data(station_str: str, context: dict, key_name: str, data: list):
-
-    response = dynamoTable.query(
-        KeyConditionExpression=Key('ID').eq(station_str)
-    )
-    items = response['Items']
-
-    filtered_data = [elem for elem in reversed(items) if datetime.strptime(elem["timestamp"], '%Y-%m-%d %H:%M:%S') >= last_hour_r]
-
-    data_s = get_data_points(filtered_data)
+    formatted_data = [f"{data['timestamp'][i]} | {data['ID'][i]} | {data[parameter_name][i]}{parameter_symbol}" for data in stations.values() for i in reversed(range(len(data['timestamp'])))]
 
-    context[key_name] = data_s
-
-    data.append(data_s)
+    return reversed(formatted_data)
 
 def storage(request):
 
     context = {}
-    data = []
 
-    # Last hour data from station1
+    # Last hour data from every station
+    stations = load_station_windows(request)
 
-    filter_data('station1', context, 'items1', data)
-
-    filter_data('station2', context, 'items2', data)
+    context['stations'] = [{'ID': station_str, 'items': rows(data)} for station_str, data in stations.items()]
 
     # The rest of the code is for the last hour data of each sensor
 
     parameters = {"Temperature":('temp', ' C°'), "RainHeight": ('rain', ' mm/h'), "WindIntensity": ('windintensity', ' m/s'), "Humidity": ('humidity', ' %'), "WindDirection": ('windirection', ' °')}
 
     for key, value in parameters.items():
-        context[value[0]] = format_data(data, key, value[1])
+        context[value[0]] = format_data(stations, key, value[1])
 
     return render(request, 'blog/storage.html', context)
 
-def get_station_data(station_str: str):
-    response_station = dynamoTable.query(
-        KeyConditionExpression=Key('ID').eq(station_str)
-    )
-    items_station = response_station['Items']
-    filtered_station_data = [elem for elem in reversed(items_station) if datetime.strptime(elem["timestamp"], '%Y-%m-%d %H:%M:%S') >= last_hour_r]
-    return filtered_station_data
-
-# new function that uses between instead of manually filtering the dates
+# function to take only the time (HH:MM) of a timestamp
 
-def all_stations_data_hour():
-    start_datetime = (datetime.now() - timedelta(hours = 1)).strftime('%Y-%m-%d %H:%M:%S')
-    end_datetime = (datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
-
-    response_station = dynamoTable.query(
-        KeyConditionExpression=Key('ID').eq('station1') & Key('timestamp').between(start_datetime, end_datetime)
-    )
-
-    items_station = response_station['Items']
-    
-    return items_station
-
-# function to get the data for each station in the desired period (1 hour)
-
-def station_data(station_str: str):
-
-    response = dynamoTable.query(
-        KeyConditionExpression=Key('ID').eq(station_str)
-    )
-    items = response['Items']
-
-    filtered_data = [elem for elem in reversed(items) if datetime.strptime(elem["timestamp"], '%Y-%m-%d %H:%M:%S') >= last_hour_r]
-
-    return filtered_data
-
-# Function to parse datetime strings
-
-def parse_datetime(datetime_str):
-    return datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
-
-# function to select the data points in each minute of the time (1 hour) that we are observing
-
-def get_data_points(data):
-
-    # Dictionary to keep track of unique minutes
-    unique_minutes = {}
-
-    # Select the first entry for each unique minute
-    filtered_entries = []
-    for entry in data:
-        minute_key = parse_datetime(entry['timestamp']).strftime('%Y-%m-%d %H:%M')
-        if minute_key not in unique_minutes:
-            filtered_entries.insert(0, entry)
-            unique_minutes[minute_key] = True
-        if len(filtered_entries) >= 60:
-            break
+def take_time(datetime_str):
+    return datetime_str[11:16]
 
-    return filtered_entries
+# Readings as columns: one list per attribute, all in the same order
 
-# function to take only the time
+def columns(items, attributes=STATION_ATTRIBUTES):
+    return {name: [item.get(name) for item in items] for name in attributes}
 
-def take_time(datetime_str):
-    # Parse the datetime string into a datetime object
-    datetime_obj = datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
+def rows(station_columns: dict):
+    return [dict(zip(station_columns, values)) for values in zip(*station_columns.values())]
 
-    # Extract the minutes and format as a string
-    minutes_str = datetime_obj.strftime('%H:%M')
+# The last reading of each minute of the last hour, oldest first
 
-    return minutes_str
+DATA_POINT_WIDTH = 60
+DATA_POINTS = 60
 
 def data_points(station_str):
-    stat_data = station_data(station_str)
-    data = get_data_points(stat_data)
-    return data
+    return downsample(columns(station_tail(station_str)), DATA_POINT_WIDTH, 'last', DATA_POINTS)
+
+# Stations come from the registry table, re-read every STATIONS_TTL seconds.
+# STATIONS is used while the registry is empty or does not exist
+
+STATIONS = ['station1', 'station2']
+STATIONS_TTL = 60
+
+def discover_stations():
+    stations = cache.get('blog:stations')
+    if stations is None:
+        kwargs = projection(['ID'])
+        stations = []
+        try:
+            while True:
+                response = aws_clients.table(REGISTRY_TABLE).scan(**kwargs)
+                stations.extend(item['ID'] for item in response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except ClientError:
+            stations = []
+        stations = sorted(stations) or STATIONS
+        cache.set('blog:stations', stations, STATIONS_TTL)
+    return stations
+
+# Every view works on the same result: the per-minute last hour of each
+# station, as columns. The stations are queried concurrently, at most
+# LOADER_WORKERS at a time, and once per request however many views or
+# templates use the data
+
+LOADER_WORKERS = 8
+
+loader_pool = ThreadPoolExecutor(max_workers=LOADER_WORKERS)
+
+def station_window(station_str: str):
+    return read_through(station_str, 'last_hour', lambda: data_points(station_str))
+
+def load_station_windows(request, stations=None):
+    loaded = getattr(request, 'station_windows', None)
+    if loaded is None:
+        stations = stations or discover_stations()
+        windows = loader_pool.map(station_window, stations)
+        loaded = dict(zip(stations, windows))
+        request.station_windows = loaded
+    return loaded
+
+# The charts share one time axis, the DATA_POINTS minutes up to now. Every
+# station's points go on the minute of their timestamp, with None for the
+# minutes it has no reading in, so the stations' lines stay aligned
+
+def chart_minutes(now=None):
+    now = now or datetime.now()
+    return [(now - timedelta(minutes = i)).strftime('%Y-%m-%d %H:%M') for i in range(DATA_POINTS - 1, -1, -1)]
+
+def align(minutes: list, timestamps: list, values: list):
+    index = {minute: i for i, minute in enumerate(minutes)}
+    aligned = [None] * len(minutes)
+    for timestamp, value in zip(timestamps, values):
+        i = index.get(timestamp[:16])
+        if i is not None:
+            aligned[i] = value
+    return aligned
 
 def charts(request):
     y_variables = ['Temperature', 'RainHeight', 'WindIntensity', 'Humidity', 'WindDirection']
-    context = {}
+    stations = load_station_windows(request)
+    minutes = chart_minutes()
+    context = {'stations': list(stations), 'time': [take_time(minute) for minute in minutes]}
 
-    for station_str in ['station1', 'station2']:
-        items_station = data_points(station_str)
-        context['time'] = [take_time(item['timestamp']) for item in items_station]
+    for station_str, columns_station in stations.items():
         for y_variable in y_variables:
             str_data = f'{station_str}_{y_variable.lower()}'
-            context[str_data] = [item[y_variable] for item in items_station]
+            context[str_data] = align(minutes, columns_station['timestamp'], columns_station[y_variable])
 
     return render(request, 'blog/chart.html', {'context':context})
+
+# Incremental refresh: the readings of each station newer than the `since`
+# timestamp the client already has (all of the last hour without it).
+# Optional `station` parameters limit the answer to those stations
+
+def since(request):
+    timestamp = request.GET.get('since', '')
+    stations = request.GET.getlist('station') or discover_stations()
+    tails = loader_pool.map(station_tail, stations)
+
+    points = {station_str: newer_than(tail, timestamp) for station_str, tail in zip(stations, tails)}
+
+    return JsonResponse({'stations': points})
+
+# Time series API: /api/series/?station=...&metric=...&start=...&end=...&width=...&how=...
+# streams newline-delimited JSON, one line per chunk of a station's series:
+# {"station": ..., "timestamp": [...], "<metric>": [...], ...}. Stations
+# default to every station, metrics to every measured attribute, the window
+# to the last hour, width to 60 seconds and how to 'last'. Metric values are
+# JSON numbers (or null) whatever the aggregate. Each DynamoDB page is
+# downsampled and sent before the next one is read, so a long window never
+# sits in memory as a whole
+
+SERIES_METRICS = ['Temperature', 'WindIntensity', 'WindDirection', 'Humidity', 'RainHeight']
+
+# 'first' and 'last' keep the stored values, Decimal or string, as the
+# aggregates turn them into floats: give every chunk floats
+
+def as_numbers(chunk: dict, metrics: list):
+    for metric in metrics:
+        array = numeric(chunk[metric])
+        if array is not None:
+            chunk[metric] = nan_to_none(array)
+    return chunk
+
+def series_chunks(station_str: str, start: str, end: str, metrics: list, width: int, how: str):
+    attributes = ['timestamp'] + metrics
+    key_condition = Key('ID').eq(station_str) & Key('timestamp').between(start, end)
+    carry = []
+    for page in query_pages(key_condition, attributes):
+        rows = carry + page
+        if not rows:
+            continue
+
+        # The last bucket of the page may go on in the next one
+        buckets = epoch_seconds([row['timestamp'] for row in rows]) // width
+        split = int(buckets.searchsorted(buckets[-1]))
+        carry = rows[split:]
+        if split:
+            yield as_numbers(downsample(columns(rows[:split], attributes), width, how), metrics)
+    if carry:
+        yield as_numbers(downsample(columns(carry, attributes), width, how), metrics)
+
+def series(request):
+    now = datetime.now()
+    start = request.GET.get('start') or (now - timedelta(hours = 1)).strftime(TIMESTAMP_FORMAT)
+    end = request.GET.get('end') or now.strftime(TIMESTAMP_FORMAT)
+    metrics = request.GET.getlist('metric') or SERIES_METRICS
+    how = request.GET.get('how', 'last')
+    try:
+        datetime.strptime(start, TIMESTAMP_FORMAT)
+        datetime.strptime(end, TIMESTAMP_FORMAT)
+        width = int(request.GET.get('width', 60))
+    except ValueError:
+        return HttpResponseBadRequest('start and end must be YYYY-MM-DD HH:MM:SS and width a number of seconds')
+    if width < 1 or how not in AGGREGATES or not set(metrics) <= set(SERIES_METRICS):
+        return HttpResponseBadRequest(f'width must be positive, how one of {AGGREGATES} and metric in {SERIES_METRICS}')
+    stations = request.GET.getlist('station') or discover_stations()
+
+    def lines():
+        for station_str in stations:
+            for chunk in series_chunks(station_str, start, end, metrics, width, how):
+                yield json.dumps(dict(station=station_str, **chunk), cls=DjangoJSONEncoder) + '\n'
+
+    return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_web.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Live readings are streamed as server-sent events by a plain ASGI app;
+# everything else goes to Django. Imported once the apps are loaded
+from blog.live import live
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == '/live/':
+        return await live(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -82,6 +82,25 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Caches the DynamoDB queries of the blog views. Local memory is per process;
+# with several workers use a shared backend (file based, Redis, memcached) so
+# they share results and the invalidation done by /api/ingested/.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'blog-station-data',
+    }
+}
+
+# Shared secret the station simulator sends to /api/ingested/; empty accepts
+# any caller, which is only fine while the site runs locally
+
+INGEST_TOKEN = os.environ.get('BLOG_INGEST_TOKEN', '')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 